@@ -0,0 +1,337 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from checking_url_tool import subdomain_to_name
+from columnar_publishers import convert_publishers_folder
+from repo_index import ComparingIndexStore
+from sqlite_store import close_process_store, set_process_store
+from start_urls_generation import (
+    Publisher, compile_spiders_regexps, generate_start_urls, insert_new_urls_to_repo,
+    load_csv_file, load_publishers
+)
+
+
+BENCHMARKS_PATH = 'benchmarks.json'
+# ? name: (spiders, publishers per spider, comparing repo URLs per spider)
+BENCHMARK_SCALES = {
+    'small': (10, 100, 1000),
+    'medium': (50, 1000, 10000),
+    'large': (100, 5000, 50000)
+}
+# ? Shapes of real spiders_on_recruitnet rows, {0} is the spider domain. Spiders without
+# ? start_link_regexp use their start_link_template with the publisher domain.
+SPIDER_SHAPES = [
+    (r'https?://[\w-]+\.{0}/[\w-]+', None),
+    (r'https?://[\w.-]+\.{0}/careers/[\w-]+', None),
+    (r'https?://careers\.{0}/[\w-]+/jobs', None),
+    (None, 'https://{{}}/careers'),
+]
+# ? Share of publisher URLs not matching their spider regexp, they go through the rearrangers
+MISS_RATE = 0.1
+# ? Share of generated start URLs already in the comparing repo
+KNOWN_RATE = 0.5
+# ? A benchmark is a regression when it gets slower than the baseline by more than this ratio
+REGRESSION_TOLERANCE = 0.2
+
+
+def make_spiders(n, rnd):
+    """make_spiders : Generates n spiders shaped like the spiders_on_recruitnet rows.
+
+    Args:
+        n (int): number of spiders.
+        rnd (random.Random): random generator, seeded for reproducible data.
+
+    Returns:
+        SpidersList: spiders with their regexps compiled.
+    """
+    spiders = list()
+    for i in range(n):
+        domain = 'ats{}.com'.format(i)
+        regexp, template = rnd.choice(SPIDER_SHAPES)
+        spiders.append({
+            'id': i,
+            'name': domain,
+            'main_domain': domain,
+            'start_link_template': template.format(domain) if template else None,
+            'start_link_regexp': regexp.format(domain.replace('.', r'\.')) if regexp else None,
+            'ignored_subdomains': 'www,api',
+            'google_query': ''
+        })
+    return compile_spiders_regexps(spiders)
+
+
+def make_publisher_url(spider, j, rnd):
+    company = 'company{}'.format(j)
+    domain = spider['main_domain']
+    if spider['start_link_regexp'] is not None and rnd.random() < MISS_RATE:
+        return 'http://www.{}.net/jobs?ref={}'.format(company, domain)
+    if spider['start_link_regexp'] is None:
+        return 'https://{}.{}/jobs/{}'.format(company, domain, rnd.randint(1, 99999))
+    if '/careers/' in spider['start_link_regexp']:
+        return 'https://{}.eu.{}/careers/{}/job/{}'.format(
+            company, domain, company, rnd.randint(1, 99999)
+        )
+    if spider['start_link_regexp'].startswith('https?://careers'):
+        return 'https://careers.{}/{}/jobs/{}'.format(domain, company, rnd.randint(1, 99999))
+    return 'https://{}.{}/{}/job/{}'.format(company, domain, company, rnd.randint(1, 99999))
+
+
+def make_publishers(spiders, m, rnd):
+    """make_publishers : Generates m publishers per spider.
+
+    Returns:
+        dict: key:value pairs like spider_name:publishers_list, spider_name being the file name.
+    """
+    publishers = dict()
+    for spider in spiders:
+        publishers[spider['main_domain'].replace('.', '_')] = [
+            Publisher(
+                'Company {}'.format(j), make_publisher_url(spider, j, rnd),
+                company_slug='company{}'.format(j)
+            )
+            for j in range(m)
+        ]
+    return publishers
+
+
+def make_comparing_repo(start_urls, k, rnd):
+    """make_comparing_repo : Generates k repo URLs per spider, KNOWN_RATE of the start URLs
+    generated from the publishers being among them.
+    """
+    comparing = dict()
+    for spider_name, spider_start_urls in start_urls.items():
+        known = [
+            publisher for publisher in spider_start_urls if rnd.random() < KNOWN_RATE
+        ][:k]
+        comparing[spider_name] = known + [
+            Publisher(
+                'Repo {}'.format(j),
+                'https://repo{}.{}/careers'.format(j, spider_name.replace('_', '.')),
+                company_slug='repo{}'.format(j)
+            )
+            for j in range(k - len(known))
+        ]
+    return comparing
+
+
+def write_publishers(folder, publishers):
+    """write_publishers : Writes publishers as spider_name.csv files, in the format of the
+    publishers folders."""
+    os.makedirs(folder, exist_ok=True)
+    for spider_name, publishers_list in publishers.items():
+        with open(os.path.join(folder, spider_name + '.csv'), 'w') as file:
+            for publisher in publishers_list:
+                file.write('{}\t{}\t{}\n'.format(
+                    publisher.company_slug, publisher.company_name, publisher.start_url
+                ))
+
+
+def make_subdomains(publishers):
+    subdomains = list()
+    for publishers_list in publishers.values():
+        for i, publisher in enumerate(publishers_list):
+            host = publisher.start_url.split('/')[2]
+            subdomains.append(host if i % 3 else host + '|External|Careers')
+    return subdomains
+
+
+def measure(function, repeat, setup=None):
+    """measure : Times function repeat times, calling setup (not timed) before each run and
+    passing its result to function.
+
+    Returns:
+        dict: min, median and max time in seconds.
+    """
+    times = list()
+    for _ in range(repeat):
+        if setup is not None:
+            arg = setup()
+            start = time.perf_counter()
+            function(arg)
+        else:
+            start = time.perf_counter()
+            function()
+        times.append(time.perf_counter() - start)
+    return {'min': min(times), 'median': statistics.median(times), 'max': max(times)}
+
+
+def run_scale(scale, repeat=3, seed=0):
+    """run_scale : Generates the synthetic data of a scale and runs every benchmark on it.
+
+    Returns:
+        dict: key:value pairs like benchmark:times
+    """
+    n, m, k = BENCHMARK_SCALES[scale]
+    rnd = random.Random(seed)
+    spiders = make_spiders(n, rnd)
+    publishers = make_publishers(spiders, m, rnd)
+    start_urls = generate_start_urls(publishers, spiders)
+    comparing = make_comparing_repo(start_urls, k, rnd)
+    subdomains = make_subdomains(publishers)
+    results = dict()
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as folder:
+        write_publishers(os.path.join(folder, 'publishers'), publishers)
+        write_publishers(os.path.join(folder, 'comparing'), comparing)
+        os.makedirs(os.path.join(folder, 'new_urls', 'from_google'))
+        files = [
+            os.path.join(folder, 'publishers', spider_name + '.csv') for spider_name in publishers
+        ]
+        comparing_publishers = load_publishers(os.path.join(folder, 'comparing'), spiders=spiders)
+        convert_publishers_folder(
+            os.path.join(folder, 'publishers'), os.path.join(folder, 'columnar')
+        )
+        csv_folder = load_publishers(os.path.join(folder, 'publishers'))
+        columnar_folder = load_publishers(os.path.join(folder, 'columnar'))
+
+        index_path = os.path.join(folder, 'comparing_index.sqlite')
+
+        def diff_setup():
+            # ? Every run indexes the comparing repo from scratch
+            close_process_store(ComparingIndexStore)
+            if os.path.exists(index_path):
+                os.remove(index_path)
+            set_process_store(ComparingIndexStore(index_path))
+            return start_urls
+
+        os.chdir(folder)
+        try:
+            results['load_csv_file'] = measure(
+                lambda: [load_csv_file(file_path) for file_path in files], repeat
+            )
+            results['load_columnar_file'] = measure(
+                lambda: [list(columnar_folder[spider_name]) for spider_name in columnar_folder],
+                repeat
+            )
+            results['iter_csv_urls'] = measure(
+                lambda: [list(csv_folder.iter_urls(spider_name)) for spider_name in csv_folder],
+                repeat
+            )
+            results['iter_columnar_urls'] = measure(
+                lambda: [
+                    list(columnar_folder.iter_urls(spider_name))
+                    for spider_name in columnar_folder
+                ],
+                repeat
+            )
+            results['generate_start_urls'] = measure(
+                lambda: generate_start_urls(publishers, spiders), repeat
+            )
+            results['insert_new_urls_to_repo'] = measure(
+                lambda start_urls: insert_new_urls_to_repo(start_urls, comparing_publishers),
+                repeat, setup=diff_setup
+            )
+            # ? Same diff once the comparing repo is indexed, as in every run after the first one
+            results['insert_new_urls_to_repo_indexed'] = measure(
+                lambda: insert_new_urls_to_repo(start_urls, comparing_publishers), repeat
+            )
+            results['subdomain_to_name'] = measure(
+                lambda: [subdomain_to_name(subdomain) for subdomain in subdomains], repeat
+            )
+        finally:
+            os.chdir(cwd)
+            close_process_store(ComparingIndexStore)
+    for benchmark, times in results.items():
+        times['items'] = n * m
+        times['items_per_second'] = n * m / times['min'] if times['min'] else None
+    return results
+
+
+def get_git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+            universal_newlines=True
+        ).strip()
+    except Exception:
+        return None
+
+
+def compare_runs(baseline, run, tolerance=REGRESSION_TOLERANCE):
+    """compare_runs : Compares the min times of run against the ones of baseline.
+
+    Returns:
+        list: regressions as strings, empty if there's none.
+    """
+    regressions = list()
+    for scale, benchmarks in run['results'].items():
+        for benchmark, times in benchmarks.items():
+            try:
+                before = baseline['results'][scale][benchmark]['min']
+            except KeyError:
+                continue
+            if before and times['min'] > before * (1 + tolerance):
+                regressions.append('{}/{}: {:.3f}s -> {:.3f}s (+{:.0%})'.format(
+                    scale, benchmark, before, times['min'], times['min'] / before - 1
+                ))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the start URL generation hot paths on synthetic data.'
+    )
+    parser.add_argument(
+        '--scales', metavar='S', nargs='+', type=str, default=['small', 'medium'],
+        choices=list(BENCHMARK_SCALES), help='Scales to run. Defaults to small and medium.'
+    )
+    parser.add_argument('--repeat', type=int, action='store', default=3)
+    parser.add_argument('--seed', type=int, action='store', default=0)
+    parser.add_argument(
+        '--output', type=str, action='store', default=BENCHMARKS_PATH,
+        help='JSON file the run is appended to.'
+    )
+    parser.add_argument(
+        '--compare', type=str, action='store', default=None,
+        help='JSON file of a previous run, exits with 1 if a benchmark regressed.'
+    )
+    parser.add_argument(
+        '--tolerance', type=float, action='store', default=REGRESSION_TOLERANCE,
+        help='Slowdown ratio tolerated by --compare.'
+    )
+    args = parser.parse_args()
+    # ? The rearrangement logs would be timed as well
+    logging.disable(logging.INFO)
+
+    run = {
+        'timestamp': time.time(),
+        'revision': get_git_revision(),
+        'python': platform.python_version(),
+        'repeat': args.repeat,
+        'seed': args.seed,
+        'results': dict()
+    }
+    for scale in args.scales:
+        run['results'][scale] = run_scale(scale, repeat=args.repeat, seed=args.seed)
+        for benchmark, times in run['results'][scale].items():
+            print('{} {}: {:.4f}s min, {:.4f}s median'.format(
+                scale, benchmark, times['min'], times['median']
+            ))
+
+    runs = list()
+    if os.path.exists(args.output):
+        with open(args.output) as file:
+            runs = json.load(file)
+    runs.append(run)
+    with open(args.output, 'w') as file:
+        json.dump(runs, file, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        # ? A file with several runs is compared against its last one
+        if isinstance(baseline, list):
+            baseline = baseline[-1]
+        regressions = compare_runs(baseline, run, tolerance=args.tolerance)
+        for regression in regressions:
+            print('[!] Regression: {}'.format(regression))
+        sys.exit(1 if any(regressions) else 0)
@@ -0,0 +1,138 @@
+import json
+import time
+import urllib.parse as prs
+from sqlite_store import SqliteStore
+
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def normalize_url(url):
+    """normalize_url : Normalizes url so the same page is stored once: lowercase scheme and host,
+    no default port and no fragment.
+
+    Args:
+        url (str): URL to normalize.
+
+    Returns:
+        str: normalized URL.
+    """
+    parsed = prs.urlsplit(url.strip())
+    scheme = parsed.scheme.lower()
+    netloc = (parsed.hostname or '').lower()
+    if parsed.port is not None and parsed.port != DEFAULT_PORTS.get(scheme):
+        netloc += ':{}'.format(parsed.port)
+    return prs.urlunsplit((scheme, netloc, parsed.path or '/', parsed.query, ''))
+
+
+def xpaths_key(check_xpaths):
+    """xpaths_key : Key of the XPath verdicts, the same for the same set of xpaths."""
+    return json.dumps(sorted(check_xpaths)) if check_xpaths is not None else ''
+
+
+class CheckStore(SqliteStore):
+    """CheckStore : Persistent store of URL check results, keyed by normalized URL. It keeps the
+    last status, the ETag and Last-Modified validators and the XPath verdicts of each URL, so a
+    later run can revalidate with a conditional GET and reuse the verdicts on 304. Entries are
+    loaded in memory when the store is opened.
+
+    Args:
+        path (str, optional): path of the sqlite file. Defaults to the CHECK_STORE_PATH
+            environment variable, or check_store.sqlite.
+    """
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS url_checks (url TEXT PRIMARY KEY, status INTEGER, '
+        'etag TEXT, last_modified TEXT, verdicts TEXT NOT NULL, checked_at REAL NOT NULL)',
+    )
+    PATH_ENV = 'CHECK_STORE_PATH'
+    DEFAULT_PATH = 'check_store.sqlite'
+
+    def __init__(self, path=None):
+        super().__init__(path)
+        self.entries = dict()
+        for url, status, etag, last_modified, verdicts, checked_at in self.fetch_all(
+                'SELECT url, status, etag, last_modified, verdicts, checked_at FROM url_checks'):
+            self.entries[url] = {
+                'status': status,
+                'etag': etag,
+                'last_modified': last_modified,
+                'verdicts': json.loads(verdicts),
+                'checked_at': checked_at
+            }
+
+    def get(self, url):
+        return self.entries.get(normalize_url(url))
+
+    def conditional_headers(self, url, check_xpaths=None):
+        """conditional_headers : Headers to revalidate url, only when a 304 answer would let us
+        reuse the stored verdict for check_xpaths.
+
+        Returns:
+            dict: If-None-Match / If-Modified-Since headers, empty if a full GET is needed.
+        """
+        entry = self.get(url)
+        headers = dict()
+        if entry is None or entry['status'] != 200 or \
+                xpaths_key(check_xpaths) not in entry['verdicts']:
+            return headers
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def verdict(self, url, check_xpaths=None):
+        """verdict : Stored verdict of check_xpaths on url, None if unknown."""
+        entry = self.get(url)
+        if entry is None:
+            return None
+        return entry['verdicts'].get(xpaths_key(check_xpaths))
+
+    def save(self, url, res, check_xpaths=None, xpaths_found=None, complete=True):
+        """save : Stores the result of a full GET of url.
+
+        Args:
+            url (str): URL checked.
+            res (requests.Response): response, None if the request failed.
+            check_xpaths (list, optional): xpaths checked. Defaults to None.
+            xpaths_found (bool, optional): verdict of check_xpaths. Defaults to None.
+            complete (bool, optional): False when the verdict comes from a partial read of the
+                page, it is then not stored. Defaults to True.
+        """
+        key = normalize_url(url)
+        with self.transaction() as db:
+            previous = self.entries.get(key)
+            entry = {
+                'status': res.status_code if res is not None else None,
+                'etag': res.headers.get('ETag') if res is not None else None,
+                'last_modified': res.headers.get('Last-Modified') if res is not None else None,
+                'verdicts': dict(),
+                'checked_at': time.time()
+            }
+            # ? Verdicts of other xpaths are kept while the page validators did not change
+            if previous is not None and (entry['etag'] or entry['last_modified']) and \
+                    (previous['etag'], previous['last_modified']) == \
+                    (entry['etag'], entry['last_modified']):
+                entry['verdicts'] = previous['verdicts']
+            if entry['status'] == 200 and complete:
+                entry['verdicts'][xpaths_key(check_xpaths)] = xpaths_found
+            self.entries[key] = entry
+            db.execute(
+                'INSERT OR REPLACE INTO url_checks '
+                '(url, status, etag, last_modified, verdicts, checked_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (
+                    key, entry['status'], entry['etag'], entry['last_modified'],
+                    json.dumps(entry['verdicts']), entry['checked_at']
+                )
+            )
+
+    def touch(self, url):
+        """touch : Marks url as revalidated (304) now."""
+        key = normalize_url(url)
+        with self.transaction() as db:
+            self.entries[key]['checked_at'] = time.time()
+            db.execute(
+                'UPDATE url_checks SET checked_at = ? WHERE url = ?',
+                (self.entries[key]['checked_at'], key)
+            )
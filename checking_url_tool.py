@@ -1,11 +1,44 @@
+import asyncio
+import csv
 import logging
+import os
+import socket
 import time
 from os import name, sep
 import re, requests
 import urllib.parse as prs
 import argparse
-import pandas as pd
-from scrapy import Selector
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from lxml import etree
+from pipeline_metrics import METRICS
+
+
+CHECK_CONCURRENCY = 32
+CHECK_PER_HOST = 4
+CHECK_TIMEOUT = 30
+# ? Consecutive unanswered requests before the remaining URLs of a host fail without a request
+CHECK_HOST_FAILURES = 3
+# ? Max bytes downloaded per page when looking for the xpaths, None for no limit
+CHECK_MAX_BYTES = None
+CHECK_CHUNK_SIZE = 16 * 1024
+# ? The partial tree is only evaluated every this many bytes while downloading
+CHECK_EVALUATE_EVERY = 64 * 1024
+# ? Only these resolver answers mean the host does not exist, others (EAI_AGAIN...) are retried
+DNS_FINAL_ERRORS = {
+    getattr(socket, error) for error in ('EAI_NONAME', 'EAI_NODATA') if hasattr(socket, error)
+}
+DNS_ATTEMPTS = 3
+DNS_RETRY_DELAY = 1
+XPATH_NAMESPACES = {
+    're': 'http://exslt.org/regular-expressions',
+    'set': 'http://exslt.org/sets'
+}
+# ? A match on a partial page is only final for expressions that can't turn false when more of
+# ? the page arrives
+NON_MONOTONIC_XPATH = re.compile(r'\b(not|last|count)\s*\(')
+
 
 def subdomain_to_name(domain):
     a = domain.split('|')
@@ -21,81 +54,414 @@ def subdomain_to_name(domain):
         return name.capitalize() + suff
 
 
-def check_urls_integrity(spiders_urls, check_xpaths=None, name_regex=None):
-    USE_SUBDOMAIN = True
+@METRICS.timed_stage('url_check')
+def check_urls_integrity(spiders_urls, check_xpaths=None, name_regex=None, journal=None,
+                         concurrency=CHECK_CONCURRENCY, per_host=CHECK_PER_HOST, store=None,
+                         max_bytes=CHECK_MAX_BYTES):
+    """check_urls_integrity : Checks every URL of every spider and writes the results to
+    donotadd/<spider_name>.csv, then prints the URLs that failed. Synchronous wrapper of
+    check_urls_integrity_async.
+
+    Args:
+        spiders_urls (dict): key:value pairs like spider_name:urls
+        check_xpaths (list, optional): xpaths, any of them must be found. Defaults to None.
+        name_regex (str, optional): regex to extract the company name. Defaults to None.
+        journal (CheckpointJournal, optional): journal of the URLs already checked.
+            Defaults to None.
+        concurrency (int, optional): max URLs checked at the same time. Defaults to
+            CHECK_CONCURRENCY.
+        per_host (int, optional): max URLs of the same host checked at the same time. Defaults
+            to CHECK_PER_HOST.
+        store (CheckStore, optional): store of the results of previous runs, used to revalidate
+            the URLs with conditional GETs. Defaults to None.
+        max_bytes (int, optional): max bytes downloaded per page when looking for the xpaths.
+            Defaults to CHECK_MAX_BYTES.
+    """
     logging.basicConfig(format='%(asctime)s %(levelname)s:%(message)s')
-    
+    failed = asyncio.run(check_urls_integrity_async(
+        spiders_urls,
+        check_xpaths=check_xpaths,
+        name_regex=name_regex,
+        journal=journal,
+        concurrency=concurrency,
+        per_host=per_host,
+        store=store,
+        max_bytes=max_bytes
+    ))
+
+    if len(failed) > 0:
+        print('====== FAILED URLS ======')
+        for url, reason in failed:
+            print(url if reason is None else '{} -- {}'.format(url, reason))
+
+
+async def check_urls_integrity_async(spiders_urls, check_xpaths=None, name_regex=None,
+                                     journal=None, concurrency=CHECK_CONCURRENCY,
+                                     per_host=CHECK_PER_HOST, store=None,
+                                     max_bytes=CHECK_MAX_BYTES):
+    """check_urls_integrity_async : Checks the URLs concurrently, at most concurrency at a time
+    and per_host for the same host, reusing keep-alive connections. Results are consumed in the
+    order of the input URLs and streamed to the spider files as they come.
+
+    Returns:
+        list: tuples like (url, reason) for the URLs that failed.
+    """
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=concurrency, pool_maxsize=per_host)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    global_limit = asyncio.Semaphore(concurrency)
+    host_limits = defaultdict(lambda: asyncio.Semaphore(per_host))
+    breaker = HostCircuitBreaker()
+    params = [check_xpaths, name_regex]
+    compiled_xpaths = compile_xpaths(check_xpaths)
+
+    # ? Every URL is scheduled once, even if several spiders share it
+    urls_to_check = dict.fromkeys(
+        url for urls in spiders_urls.values() for url in urls if re.search('^https?://', url)
+    )
+    unresolved_hosts = await find_unresolved_hosts(
+        {prs.urlparse(url).hostname for url in urls_to_check}, concurrency
+    )
+
+    async def check(url):
+        result = journal.get_check(url, params) if journal is not None else None
+        if result is not None:
+            return result
+        parsed_url = prs.urlparse(url)
+        if parsed_url.hostname in unresolved_hosts:
+            return host_failure(url, 'DNS resolution failed for {}'.format(parsed_url.hostname))
+        host = parsed_url.netloc
+        async with host_limits[host], global_limit:
+            if breaker.is_open(host):
+                return host_failure(url, breaker.open_hosts[host])
+            start = time.perf_counter()
+            try:
+                result = await loop.run_in_executor(
+                    executor, check_url, session, url, check_xpaths, name_regex, store,
+                    compiled_xpaths, max_bytes
+                )
+            except Exception as e:
+                # ? One URL failing in an unexpected way must not cancel the whole run
+                logging.info('[!] Catched exception checking {}:\n{}'.format(url, e))
+                result = {
+                    'checked': list(), 'passed': False, 'reason': 'Check error: {}'.format(e),
+                    'reachable': False
+                }
+            METRICS.observe('url_check_duration_seconds', time.perf_counter() - start)
+        breaker.record(host, result)
+        if journal is not None:
+            journal.save_check(url, params, result)
+        return result
+
+    tasks = {url: asyncio.ensure_future(check(url)) for url in urls_to_check}
+
     failed = []
-    passed = []
-    # checked_spiders_urls = dict()
-    for spider_name, urls in spiders_urls.items():
-        logging.info('[!] Checking {} spider URLs.'.format(spider_name))
-        checked_publisher_urls = list()
-        for url in urls:
-            go = False
-            if re.search('^https?://', url):
-                go = True
-            
-            if go and not url in passed:
-                success = False
-                res = None
+    passed = set()
+    try:
+        for spider_name, urls in spiders_urls.items():
+            logging.info('[!] Checking {} spider URLs.'.format(spider_name))
+            writer = CheckedUrlsWriter('donotadd/{}.csv'.format(spider_name))
+            try:
+                for url in urls:
+                    if url not in tasks or url in passed:
+                        continue
+                    result = await tasks[url]
+                    writer.write(result['checked'])
+                    if result['passed']:
+                        passed.add(url)
+                    elif result['passed'] is not None:
+                        failed.append((url, result.get('reason')))
+            finally:
+                writer.close()
+    finally:
+        for task in tasks.values():
+            task.cancel()
+        executor.shutdown(wait=False)
+        session.close()
+    METRICS.inc('url_checks_passed_total', len(passed))
+    METRICS.inc('url_checks_failed_total', len(failed))
+    return failed
+
+
+async def find_unresolved_hosts(hosts, concurrency=CHECK_CONCURRENCY):
+    """find_unresolved_hosts : Resolves every host concurrently before checking their URLs. Only
+    hosts the resolver reports as nonexistent are returned, transient errors are retried and then
+    ignored.
+
+    Args:
+        hosts (set): hosts to resolve.
+        concurrency (int, optional): max resolutions at the same time. Defaults to
+            CHECK_CONCURRENCY.
+
+    Returns:
+        set: hosts that could not be resolved.
+    """
+    loop = asyncio.get_running_loop()
+    limit = asyncio.Semaphore(concurrency)
+
+    async def resolve(host):
+        async with limit:
+            for attempt in range(1, DNS_ATTEMPTS + 1):
                 try:
-                    res = requests.get(url, timeout=30)
-                    success = True
-                except Exception as e:
-                    logging.info('[!] Catched exception on {}:\n{}'.format(url, e))
-                    time.sleep(2)
-
-                if res is not None and res.status_code == 200:
-                    logging.info('[!] {} -- {}.'.format(url, res.status_code))
-                    if check_xpaths is not None:
-                        sel_main = Selector(text=res.text)
-                        xpaths_found = any(
-                            [
-                                sel_main.xpath(xpath).get() is not None for xpath in check_xpaths
-                            ]
-                        )
-                        if xpaths_found:
-                            checked_publisher_urls.append(
-                                create_checked_dict(res, url, name_regex=name_regex)
-                            )
-                            logging.info('[!] Success!')
-                            passed.append(url)
-                        else:
-                            logging.info('[!] Xpath was not found!')
-                            checked_publisher_urls.append(
-                                create_checked_dict(
-                                    res, 
-                                    url, 
-                                    result='XPATH not found', 
-                                    name_regex=name_regex
-                                )
-                            )
-                            failed.append(url)
-                    checked_publisher_urls.append(
-                        create_checked_dict(res, url, result='', name_regex=name_regex)
-                    )
-                else:
-                    if res is not None:
-                        logging.info('[!] {} -- {}.'.format(url, res.status_code))
-                    else:
-                        logging.info('[!] {} -- Failed.'.format(url))
-                    failed.append(url)
-        if any(checked_publisher_urls):
-            df = pd.DataFrame.from_dict(checked_publisher_urls)
-            df.drop_duplicates(subset=None, keep='first', inplace=True)
-            df.to_csv(
-                'donotadd/{}.csv'.format(spider_name), 
-                sep='\t', 
-                index=False, 
-                index_label=False,
-                header=False
+                    await loop.getaddrinfo(host, None)
+                    return None
+                except UnicodeError:
+                    return host
+                except socket.gaierror as e:
+                    if e.errno in DNS_FINAL_ERRORS:
+                        return host
+                    if attempt < DNS_ATTEMPTS:
+                        await asyncio.sleep(DNS_RETRY_DELAY * attempt)
+                        continue
+                    # ? Still a transient error, the requests of the host will tell
+                    logging.info('[!] Could not resolve {} for now: {}'.format(host, e))
+                    return None
+
+    unresolved = set(await asyncio.gather(*(resolve(host) for host in hosts if host)))
+    unresolved.discard(None)
+    if any(unresolved):
+        logging.info('[!] Could not resolve: {}'.format(', '.join(sorted(unresolved))))
+    return unresolved
+
+
+class HostCircuitBreaker():
+    """HostCircuitBreaker : Opens the circuit of a host after threshold consecutive requests
+    that got no answer at all, so its remaining URLs fail at once instead of waiting for the
+    timeout. HTTP errors don't count, the host answered.
+    """
+
+    def __init__(self, threshold=CHECK_HOST_FAILURES):
+        self.threshold = threshold
+        self.failures = defaultdict(int)
+        self.open_hosts = dict()
+
+    def is_open(self, host):
+        return host in self.open_hosts
+
+    def record(self, host, result):
+        if result.get('reachable', True):
+            self.failures[host] = 0
+            return
+        self.failures[host] += 1
+        if self.failures[host] >= self.threshold and host not in self.open_hosts:
+            logging.info('[!] Circuit open for {}.'.format(host))
+            self.open_hosts[host] = 'Host unreachable after {} errors, last: {}'.format(
+                self.failures[host], result.get('reason')
             )
-    
-    if len(failed) > 0:
-        print('====== FAILED URLS ======')
-        for url in failed:
-            print(url)
+
+
+def host_failure(url, reason):
+    logging.info('[!] {} -- Skipped: {}.'.format(url, reason))
+    METRICS.inc('url_checks_skipped_total')
+    return {'checked': list(), 'passed': False, 'reason': reason, 'reachable': False}
+
+
+def compile_xpaths(check_xpaths):
+    """compile_xpaths : Compiles the xpaths once per run.
+
+    Args:
+        check_xpaths (list): xpaths to look for, None for no check.
+
+    Returns:
+        list: tuples like (compiled_xpath, can_stop_early), None if check_xpaths is None.
+    """
+    if check_xpaths is None:
+        return None
+    return [
+        (
+            etree.XPath(xpath, namespaces=XPATH_NAMESPACES),
+            NON_MONOTONIC_XPATH.search(xpath) is None
+        )
+        for xpath in check_xpaths
+    ]
+
+
+def xpath_found(compiled_xpath, root):
+    # ? Same rule as Selector.xpath(xpath).get() is not None: node-sets must not be empty, any
+    # ? other result (string, number, boolean) counts as found
+    result = compiled_xpath(root)
+    return bool(result) if isinstance(result, list) else True
+
+
+def find_xpaths_in_response(res, compiled_xpaths, max_bytes=CHECK_MAX_BYTES):
+    """find_xpaths_in_response : Streams the body of res into an lxml parser, stopping at the first
+    xpath found. The download stops as soon as an xpath that can be decided on a partial page
+    is found, or when max_bytes have been read.
+
+    Args:
+        res (requests.Response): streamed response.
+        compiled_xpaths (list): xpaths as returned by compile_xpaths.
+        max_bytes (int, optional): max bytes to download. Defaults to CHECK_MAX_BYTES.
+
+    Returns:
+        tuple: (found, truncated). found is True if any xpath was found, truncated is True when
+        the download stopped at max_bytes before an xpath was found.
+
+    Raises:
+        requests.RequestException: the body download was cut or timed out.
+    """
+    parser = etree.HTMLPullParser(events=('start',))
+    early_xpaths = [xpath for xpath, can_stop_early in compiled_xpaths if can_stop_early]
+    root = None
+    read = 0
+    evaluated_at = 0
+    truncated = False
+    try:
+        for chunk in res.iter_content(CHECK_CHUNK_SIZE):
+            parser.feed(chunk)
+            read += len(chunk)
+            for _, element in parser.read_events():
+                if root is None:
+                    root = element.getroottree().getroot()
+            if root is not None and any(early_xpaths) and \
+                    read - evaluated_at >= CHECK_EVALUATE_EVERY:
+                evaluated_at = read
+                if any(xpath_found(xpath, root) for xpath in early_xpaths):
+                    return True, False
+            if max_bytes is not None and read >= max_bytes:
+                truncated = True
+                break
+    finally:
+        res.close()
+    try:
+        root = parser.close()
+    except etree.XMLSyntaxError:
+        if root is None:
+            return False, truncated
+    found = any(xpath_found(xpath, root) for xpath, _ in compiled_xpaths)
+    return found, truncated and not found
+
+
+def check_url(session, url, check_xpaths=None, name_regex=None, store=None,
+              compiled_xpaths=None, max_bytes=CHECK_MAX_BYTES):
+    """check_url : Requests url and looks for check_xpaths on it. With a store, a URL already
+    checked is revalidated with a conditional GET and a 304 answer reuses the stored verdict.
+
+    Args:
+        session (requests.Session): session used for the request.
+        url (str): URL to check.
+        check_xpaths (list, optional): xpaths, any of them must be found. Defaults to None.
+        name_regex (str, optional): regex to extract the company name. Defaults to None.
+        store (CheckStore, optional): store of previous check results. Defaults to None.
+        compiled_xpaths (list, optional): check_xpaths as returned by compile_xpaths. Defaults
+            to None (compiled here).
+        max_bytes (int, optional): max bytes to download. Defaults to CHECK_MAX_BYTES.
+
+    Returns:
+        dict: 'checked' holds the rows to write for the URL, 'passed' is True or False, or None
+        when the URL answered 200 and there were no xpaths to check, 'reason' why it failed and
+        'reachable' whether the host answered at all.
+    """
+    checked = list()
+    passed = None
+    reason = None
+    res = None
+    headers = store.conditional_headers(url, check_xpaths) if store is not None else dict()
+    try:
+        res = session.get(url, timeout=CHECK_TIMEOUT, headers=headers, stream=True)
+    except Exception as e:
+        logging.info('[!] Catched exception on {}:\n{}'.format(url, e))
+        reason = 'Request error: {}'.format(e)
+
+    status = res.status_code if res is not None else None
+    METRICS.inc(
+        'http_responses_total',
+        status_class='{}xx'.format(status // 100) if status is not None else 'error'
+    )
+    xpaths_found = None
+    truncated = False
+    read_error = None
+    if status == 304 and any(headers):
+        logging.info('[!] {} -- Not modified.'.format(url))
+        store.touch(url)
+        status = 200
+        xpaths_found = store.verdict(url, check_xpaths)
+    else:
+        if status == 200 and check_xpaths is not None:
+            if compiled_xpaths is None:
+                compiled_xpaths = compile_xpaths(check_xpaths)
+            # ? The body is streamed, a cut or stalled download only fails here
+            try:
+                xpaths_found, truncated = find_xpaths_in_response(
+                    res, compiled_xpaths, max_bytes=max_bytes
+                )
+            except requests.RequestException as e:
+                logging.info('[!] Catched exception reading {}:\n{}'.format(url, e))
+                read_error = 'Read error: {}'.format(e)
+        elif res is not None:
+            res.close()
+        if store is not None and read_error is None:
+            # ? A "not found" on a partial page must not be replayed on 304 by a later run
+            store.save(
+                url, res, check_xpaths=check_xpaths, xpaths_found=xpaths_found,
+                complete=not truncated
+            )
+
+    if read_error is not None:
+        return {'checked': checked, 'passed': False, 'reason': read_error, 'reachable': False}
+    if status == 200:
+        logging.info('[!] {} -- {}.'.format(url, status))
+        if check_xpaths is not None:
+            if xpaths_found:
+                checked.append(
+                    create_checked_dict(res, url, result=status, name_regex=name_regex)
+                )
+                logging.info('[!] Success!')
+                passed = True
+            else:
+                logging.info('[!] Xpath was not found!')
+                reason = 'XPATH not found'
+                checked.append(
+                    create_checked_dict(
+                        res, 
+                        url, 
+                        result='XPATH not found', 
+                        name_regex=name_regex
+                    )
+                )
+                passed = False
+        checked.append(
+            create_checked_dict(res, url, result='', name_regex=name_regex)
+        )
+    else:
+        if res is not None:
+            logging.info('[!] {} -- {}.'.format(url, status))
+            reason = 'HTTP {}'.format(status)
+        else:
+            logging.info('[!] {} -- Failed.'.format(url))
+        passed = False
+    return {'checked': checked, 'passed': passed, 'reason': reason, 'reachable': res is not None}
+
+
+class CheckedUrlsWriter():
+    """CheckedUrlsWriter : Streams the checked rows of a spider to its tab separated file, skipping
+    duplicated rows. The file is only created once there is a row to write.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.file = None
+        self.writer = None
+        self.written = set()
+
+    def write(self, rows):
+        for row in rows:
+            values = (row['company_name'], row['start_url'], row['result'])
+            if values in self.written:
+                continue
+            if self.file is None:
+                self.file = open(self.file_path, 'w', newline='')
+                self.writer = csv.writer(self.file, delimiter='\t', lineterminator=os.linesep)
+            self.writer.writerow(values)
+            self.written.add(values)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
 
 def create_checked_dict(request, start_url, result=None, name_regex=None):
     publisher = dict()
@@ -0,0 +1,84 @@
+import json
+import time
+from sqlite_store import SqliteStore
+
+
+# ? Entries older than this are not reused, in hours
+CHECKPOINT_MAX_AGE = 24
+
+
+class CheckpointJournal(SqliteStore):
+    """CheckpointJournal : sqlite journal of the Google queries already performed (query -> URLs
+    extracted) and of the URLs already checked (URL -> check result). Everything is always
+    written; entries are only read back when resuming, and only if younger than max_age.
+
+    Args:
+        path (str, optional): path of the sqlite file. Defaults to the CHECKPOINT_JOURNAL_PATH
+            environment variable, or checkpoint_journal.sqlite.
+        max_age (float, optional): max age of reused entries, in hours. Defaults to
+            CHECKPOINT_MAX_AGE.
+        resume (bool, optional): reuse the entries of previous runs. Defaults to True.
+    """
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS queries (spider_name TEXT NOT NULL, query TEXT NOT NULL, '
+        'params TEXT NOT NULL, urls TEXT NOT NULL, created_at REAL NOT NULL, '
+        'PRIMARY KEY (spider_name, query, params))',
+        'CREATE TABLE IF NOT EXISTS url_checks (url TEXT NOT NULL, params TEXT NOT NULL, '
+        'result TEXT NOT NULL, created_at REAL NOT NULL, PRIMARY KEY (url, params))'
+    )
+    PATH_ENV = 'CHECKPOINT_JOURNAL_PATH'
+    DEFAULT_PATH = 'checkpoint_journal.sqlite'
+
+    def __init__(self, path=None, max_age=CHECKPOINT_MAX_AGE, resume=True):
+        super().__init__(path)
+        self.max_age = max_age * 3600
+        self.resume = resume
+
+    def migrate(self):
+        # ? Journals written before queries were keyed by their params can't be reused
+        if not any(
+                column[1] == 'params'
+                for column in self.db.execute('PRAGMA table_info(queries)').fetchall()):
+            self.db.execute('DROP TABLE IF EXISTS queries')
+
+    def _get(self, sql, args):
+        if not self.resume:
+            return None
+        row = self.fetch_one(sql, args)
+        if row is None or time.time() - row[1] > self.max_age:
+            return None
+        return json.loads(row[0])
+
+    def _save(self, sql, args):
+        self.write(sql, args + (time.time(),))
+
+    def get_query(self, spider_name, query, params):
+        """get_query : Returns the URLs extracted for query with the same params (max URLs, result
+        offset, backend...), None if it has to be performed."""
+        return self._get(
+            'SELECT urls, created_at FROM queries '
+            'WHERE spider_name = ? AND query = ? AND params = ?',
+            (spider_name, query, json.dumps(params, sort_keys=True))
+        )
+
+    def save_query(self, spider_name, query, params, urls):
+        self._save(
+            'INSERT OR REPLACE INTO queries (spider_name, query, params, urls, created_at) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (spider_name, query, json.dumps(params, sort_keys=True), json.dumps(urls))
+        )
+
+    def get_check(self, url, params):
+        """get_check : Returns the check result of url made with the same params (xpaths, name
+        regex...), None if it has to be checked."""
+        return self._get(
+            'SELECT result, created_at FROM url_checks WHERE url = ? AND params = ?',
+            (url, json.dumps(params))
+        )
+
+    def save_check(self, url, params, result):
+        self._save(
+            'INSERT OR REPLACE INTO url_checks (url, params, result, created_at) '
+            'VALUES (?, ?, ?, ?)',
+            (url, json.dumps(params), json.dumps(result))
+        )
@@ -0,0 +1,223 @@
+import argparse
+import logging
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+
+COLUMNAR_EXTENSION = '.pubcol'
+COLUMNAR_MAGIC = b'PUBCOL1\x00'
+COLUMNS = ('company_slug', 'company_name', 'start_url')
+# ? magic, rows, then (offsets position, data position, data length) per column
+HEADER = struct.Struct('<8sQ' + 'QQQ' * len(COLUMNS))
+OFFSET = struct.Struct('<Q')
+# ? Rows decoded at a time when reading a column
+COLUMNAR_DECODE_ROWS = 4096
+
+
+class ColumnarFormatError(Exception):
+    """ColumnarFormatError : Raised when a file is not a valid columnar publishers file."""
+
+
+def align(position):
+    return (position + 7) & ~7
+
+
+def write_columnar_file(file_path, rows):
+    """write_columnar_file : Writes publishers as a columnar file. Each column is stored as an
+    array of n + 1 little-endian uint64 offsets followed by its UTF-8 values back to back, so a
+    reader can memory-map the file and decode only the column it needs. The file is written
+    under a temporary name and then moved in place.
+
+    Args:
+        file_path (str): path of the columnar file.
+        rows (iterable): tuples like (company_slug, company_name, start_url).
+
+    Returns:
+        int: number of rows written.
+    """
+    offsets = [array('Q', [0]) for _ in COLUMNS]
+    data = [bytearray() for _ in COLUMNS]
+    n = 0
+    for row in rows:
+        for i, value in enumerate(row):
+            data[i] += value.encode('utf-8')
+            offsets[i].append(len(data[i]))
+        n += 1
+
+    header = [COLUMNAR_MAGIC, n]
+    position = align(HEADER.size)
+    for i in range(len(COLUMNS)):
+        header += [position, position + 8 * (n + 1), len(data[i])]
+        position = align(position + 8 * (n + 1) + len(data[i]))
+
+    temp_path = file_path + '.tmp'
+    with open(temp_path, 'wb') as file:
+        file.write(HEADER.pack(*header))
+        for i in range(len(COLUMNS)):
+            file.write(b'\x00' * (align(file.tell()) - file.tell()))
+            if sys.byteorder == 'big':
+                offsets[i].byteswap()
+            offsets[i].tofile(file)
+            file.write(data[i])
+    os.replace(temp_path, file_path)
+    return n
+
+
+def read_header(buffer, file_path):
+    """read_header : Unpacks the header of a mapped columnar file and checks that every column it
+    describes lies within the file and that its offsets span its data.
+
+    Returns:
+        tuple: header values, see HEADER.
+
+    Raises:
+        ColumnarFormatError: the file is not a columnar file, or it is truncated or corrupted.
+    """
+    if len(buffer) < HEADER.size:
+        raise ColumnarFormatError('{} is too short'.format(file_path))
+    header = HEADER.unpack_from(buffer, 0)
+    if header[0] != COLUMNAR_MAGIC:
+        raise ColumnarFormatError('{} is not a columnar publishers file'.format(file_path))
+    n = header[1]
+    for i, column in enumerate(COLUMNS):
+        offsets_position, data_position, data_length = header[2 + 3 * i:5 + 3 * i]
+        if offsets_position < HEADER.size or offsets_position % 8 or \
+                data_position != offsets_position + 8 * (n + 1) or \
+                data_position + data_length > len(buffer) or \
+                OFFSET.unpack_from(buffer, offsets_position)[0] != 0 or \
+                OFFSET.unpack_from(buffer, offsets_position + 8 * n)[0] != data_length:
+            raise ColumnarFormatError('{} is truncated or corrupted, bad {} column'.format(
+                file_path, column
+            ))
+    return header
+
+
+def iter_column(view, header, i, file_path):
+    """iter_column : Yields the values of the column i of a mapped columnar file, decoding them
+    from the mapped pages COLUMNAR_DECODE_ROWS at a time. A block without multibyte characters
+    is decoded at once and sliced, otherwise its bytes are copied and each value is decoded on
+    its own.
+
+    Yields:
+        str: values of the column.
+    """
+    offsets_position, data_position, data_length = header[2 + 3 * i:5 + 3 * i]
+    n = header[1]
+    for first in range(0, n, COLUMNAR_DECODE_ROWS):
+        last = min(first + COLUMNAR_DECODE_ROWS, n)
+        offsets = array('Q')
+        offsets.frombytes(view[offsets_position + 8 * first:offsets_position + 8 * (last + 1)])
+        if sys.byteorder == 'big':
+            offsets.byteswap()
+        start, end = offsets[0], offsets[-1]
+        if not start <= end <= data_length:
+            raise ColumnarFormatError('{} is corrupted, bad offsets in the {} column'.format(
+                file_path, COLUMNS[i]
+            ))
+        # ? The ASCII decoding stops at the first multibyte character, the bytes of a block that
+        # ? has one are then copied once to decode each value on its own
+        with view[data_position + start:data_position + end] as block:
+            try:
+                text, data = str(block, 'ascii'), None
+            except UnicodeDecodeError:
+                text, data = None, block.tobytes()
+        if text is not None:
+            yield from [text[value_start - start:value_end - start]
+                        for value_start, value_end in zip(offsets, offsets[1:])]
+        else:
+            yield from [data[value_start - start:value_end - start].decode('utf-8')
+                        for value_start, value_end in zip(offsets, offsets[1:])]
+
+
+def iter_columnar_file(file_path, columns=COLUMNS):
+    """iter_columnar_file : Reads the rows of a columnar file from a read-only memory map. Values
+    are decoded from the mapped pages a block of rows at a time (see iter_column), so memory does
+    not grow with the file, and the pages of the columns not requested are never read from disk.
+    The file stays mapped until the rows are exhausted or the generator is closed.
+
+    Args:
+        file_path (str): path of the columnar file.
+        columns (tuple, optional): columns to read, among COLUMNS. Defaults to COLUMNS.
+
+    Yields:
+        tuple or str: values of the columns of each row, the value alone for a single column.
+
+    Raises:
+        ColumnarFormatError: the file is not a columnar file, or it is truncated or corrupted.
+    """
+    indexes = [COLUMNS.index(column) for column in columns]
+    with open(file_path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size < HEADER.size:
+            raise ColumnarFormatError('{} is too short'.format(file_path))
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer, \
+                memoryview(buffer) as view:
+            header = read_header(view, file_path)
+            values = [iter_column(view, header, i, file_path) for i in indexes]
+            try:
+                if len(values) == 1:
+                    yield from values[0]
+                else:
+                    yield from zip(*values)
+            finally:
+                # ? The map can't be closed while a column still holds a view on it
+                for column_values in values:
+                    column_values.close()
+
+
+def convert_publishers_folder(source_path, target_path=None, force=False):
+    """convert_publishers_folder : Converts every spider CSV file of a publishers folder to the
+    columnar format, next to it or in target_path. Files whose columnar copy is newer than the
+    CSV file are skipped unless force is given.
+
+    Args:
+        source_path (str): folder of spider_name.csv files.
+        target_path (str, optional): folder of the columnar files. Defaults to source_path.
+        force (bool, optional): convert every file. Defaults to False.
+
+    Returns:
+        int: number of files converted.
+    """
+    from start_urls_generation import iter_csv_file
+
+    target_path = target_path or source_path
+    os.makedirs(target_path, exist_ok=True)
+    converted = 0
+    for file_name in sorted(os.listdir(source_path)):
+        if not file_name.endswith('.csv'):
+            continue
+        csv_path = os.path.join(source_path, file_name)
+        columnar_path = os.path.join(
+            target_path, file_name.replace('.csv', COLUMNAR_EXTENSION)
+        )
+        if not force and os.path.exists(columnar_path) and \
+                os.stat(columnar_path).st_mtime_ns >= os.stat(csv_path).st_mtime_ns:
+            continue
+        n = write_columnar_file(columnar_path, (
+            (publisher.company_slug, publisher.company_name, publisher.start_url)
+            for publisher in iter_csv_file(csv_path)
+        ))
+        logging.info('[!] Converted {} ({} publishers).'.format(file_name, n))
+        converted += 1
+    return converted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Converts a folder of spider CSV files to the columnar publishers format.'
+    )
+    parser.add_argument('source', type=str, help='Folder of spider CSV files.')
+    parser.add_argument(
+        'target', type=str, nargs='?', default=None,
+        help='Folder of the columnar files. Defaults to the source folder.'
+    )
+    parser.add_argument(
+        '--force', action='store_true', default=False,
+        help='Convert every file, even the ones already up to date.'
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    converted = convert_publishers_folder(args.source, args.target, force=args.force)
+    print('[!] {} files converted.'.format(converted))
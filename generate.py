@@ -1,11 +1,13 @@
 import argparse
+import os
 import sys
 import logging
-import urllib.parse
 import logging
 
 from dotenv import load_dotenv, find_dotenv
-from start_urls_generation import *
+from pipeline_metrics import METRICS
+# ? Each action imports the modules it uses, so e.g. check_spider_urls never loads selenium.
+# ? Run import_budget.py after touching the imports.
 
 
 class Generate():
@@ -48,15 +50,21 @@ class Generate():
             WHERE  
                 `is_ats_site`=1 AND `is_excluded`=0{};
         """
+        # ? Primary key or update timestamp of monitor_data, only rows from its last processed
+        # ? value are ingested unless --full is given. The default primary key only picks up new
+        # ? rows, changed rows are picked up with a column set on every update, e.g. an
+        # ? `updated_at` TIMESTAMP ... ON UPDATE CURRENT_TIMESTAMP
+        self.LINKEDIN_WATERMARK_COLUMN = os.getenv('LINKEDIN_WATERMARK_COLUMN', 'id')
         self.SQL_FOR_LINKEDIN_DB = """
             SELECT 
                 `company_name_in_linkedin`,
                 `company_domain`,
-                `example_job_posting`
+                `example_job_posting`,
+                `{0}`
             FROM 
                 `monitor_data` 
             WHERE 
-                `is_excluded`=0 
+                `is_excluded`=0{1} 
             ORDER BY 
                 `company_domain`;
         """
@@ -83,13 +91,26 @@ class Generate():
             print('[!] Unrecognized command.')
             parser.print_help()
             exit(1)
-        getattr(self, self.main_args.action)()
+        # ? Metrics are exported even if the action fails, so failed cron runs show up too
+        try:
+            getattr(self, self.main_args.action)()
+        finally:
+            METRICS.export(action=self.main_args.action)
 
 
     def generate_from_google(self):
+        from serp_scheduler import QUERIES_PER_MINUTE, SERP_BACKENDS
+        from checkpoint_journal import CHECKPOINT_MAX_AGE, CheckpointJournal
+        from checking_url_tool import check_urls_integrity
+        from check_store import CheckStore
+        from start_urls_generation import (
+            generate_google_query, generate_start_urls, insert_new_urls_to_repo,
+            load_publishers, load_spiders, make_google_query, preresolve_redirects
+        )
         parser = argparse.ArgumentParser(
             description='Generates Google search queries, performs them and extracts the URLs.',
-            usage='generate.py generate_from_google [--spiders] [--max] [--input_folder]'
+            usage='generate.py generate_from_google [--spiders] [--max] [--browsers] [--proxies] '\
+                '[--queries_per_minute] [--serp_backend] [--resume] [--max_age] [--workers]'
         )
         parser.add_argument(
             '--spiders', 
@@ -135,6 +156,57 @@ class Generate():
             default=0,
             help='Page to start looking for in the Google query.'
         )
+        parser.add_argument(
+            '--browsers',
+            type=int,
+            action='store',
+            default=1,
+            help='Number of browsers performing the Google queries.'
+        )
+        parser.add_argument(
+            '--proxies',
+            metavar='P',
+            action='store',
+            type=str,
+            nargs='+',
+            default=None,
+            help='Proxies assigned to the browsers, one egress per proxy.'
+        )
+        parser.add_argument(
+            '--queries_per_minute',
+            type=float,
+            action='store',
+            default=QUERIES_PER_MINUTE,
+            help='Result pages requested per minute through each egress.'
+        )
+        parser.add_argument(
+            '--serp_backend',
+            type=str,
+            action='store',
+            choices=SERP_BACKENDS,
+            default='browser',
+            help='How results pages are fetched: a Chrome browser or raw HTML parsed with lxml.'
+        )
+        parser.add_argument(
+            '--resume',
+            action='store_true',
+            default=False,
+            help='Reuse the queries and URL checks journaled by previous runs.'
+        )
+        parser.add_argument(
+            '--max_age', '--max-age',
+            type=float,
+            action='store',
+            default=CHECKPOINT_MAX_AGE,
+            help='Max age in hours of the journal entries reused with --resume.'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            action='store',
+            default=1,
+            help='Number of processes used to generate start URLs. Defaults to 1.'
+        )
         args = parser.parse_args(sys.argv[2:])
         # ? If we use --spider_name argument, we must provide --query argument as well
         # if (args.spider_name and args.query is None) or (args.spider_name is None and args.query):
@@ -148,6 +220,9 @@ class Generate():
         queries_for_implemented_spiders = (
             args.query is None and args.spider_name is None
         )
+        spiders = load_spiders(
+            self.SQL_QUERY_FOR_SPIDERS, self.DB_HOST, self.DB_USER, self.DB_PASS, self.DB_NAME
+        )
         if queries_for_implemented_spiders:
             queries = generate_google_query(
                 self.DB_HOST,
@@ -157,7 +232,8 @@ class Generate():
                 self.GOOGLE_INCLUDE_TPL,
                 self.GOOGLE_IGNORE1_TPL,
                 look_for=args.spiders,
-                query=self.SQL_QUERY_FOR_QUERY_GENERATION
+                query=self.SQL_QUERY_FOR_QUERY_GENERATION,
+                spiders=spiders
             )
         elif not queries_for_implemented_spiders:
             # ? Generate a dict {spider_name: queries}
@@ -167,95 +243,144 @@ class Generate():
                 ' [<spiders>] or [<spider_name>] and [<query>].')
             exit(1)
 
-        # Perfom the queries and extract the URLs
+        # Perfom the queries and extract the URLs, journaling them to resume from there
+        journal = CheckpointJournal(max_age=args.max_age, resume=args.resume)
         logging.info('[!] Perfoming Google searches.')
-        spiders_urls = make_google_query(queries, max_urls=args.max, deepnest=args.deepnest)
+        spiders_urls = make_google_query(
+            queries,
+            max_urls=args.max,
+            deepnest=args.deepnest,
+            browsers=args.browsers,
+            proxies=args.proxies,
+            queries_per_minute=args.queries_per_minute,
+            journal=journal,
+            backend=args.serp_backend
+        )
 
         # Check the intregrity of the extracted URLs
         logging.info('[!] Checking URLs extracted and giving them names.')
-        check_urls_integrity(spiders_urls, name_regex=args.name_regex)
+        check_urls_integrity(
+            spiders_urls, name_regex=args.name_regex, journal=journal, store=CheckStore()
+        )
 
         # Load input data
         logging.info('[!] Loading input URLs and repo URLs')
-        spiders = load_spiders_from_db(
-            self.SQL_QUERY_FOR_SPIDERS, self.DB_HOST, self.DB_USER, self.DB_PASS, self.DB_NAME
-        )
-        publishers = load_publishers(self.PUBLISHERS_PATH)
-        comparing_publishers = load_publishers(self.PUBLISHERS_COMPARING_PATH)
+        publishers = load_publishers(self.PUBLISHERS_PATH, spiders=spiders)
+        comparing_publishers = load_publishers(self.PUBLISHERS_COMPARING_PATH, spiders=spiders)
 
         # Generate start_urls from input data
         logging.info('[!] Generating start URLs.')
-        start_urls = generate_start_urls(publishers, spiders)
+        preresolve_redirects(publishers, spiders)
+        start_urls = generate_start_urls(publishers, spiders, workers=args.workers)
 
         # Compare generated start_urls with urls already in the repo
         insert_new_urls_to_repo(start_urls, comparing_publishers, from_action=self.main_args.action)
 
 
     def generate_from_linkedin_db(self):
-        # ? Parser not needed until to now
-        # ? DB setup
-        try:
-            db = MySQLdb.connect(
-                self.DB_HOST,
-                self.DB_USER,
-                self.DB_PASS,
-                self.DB_NAME,
-                use_unicode=True,
-                charset='utf8'
-            )
-            cursor = db.cursor()
-            sql = self.SQL_FOR_LINKEDIN_DB
-            cursor.execute(sql)
-        except Exception as e:
-            self.logger.info('[!] Error accesing to LinkedIn database.')
-            return
-
-        # ? Extract the required rows; 
-        # ? 0:company_name_in_linkedin, 1:company_domain, 2:example_job_posting
-        links = cursor.fetchall()
-        urls = list()
-        for row in links:
-            company_name = urllib.parse.unquote(row[0]).replace('-', ' ').title()
-            urls.append(
-                {
-                    'company_name': company_name,
-                    'company_domain': row[1],
-                    'example_job_posting': row[2]
-                }
-            )
+        from start_urls_generation import (
+            DB_FETCH_BATCH_SIZE, build_domain_index, generate_start_urls, insert_new_urls_to_repo,
+            load_publishers, load_spiders, preresolve_redirects, route_linkedin_rows,
+            stream_rows_from_db
+        )
+        from ingestion_watermark import WatermarkStore
+        parser = argparse.ArgumentParser(
+            description='Generates start URLs from the LinkedIn database.',
+            usage='generate.py generate_from_linkedin_db [--workers] [--batch_size] [--full]'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            action='store',
+            default=1,
+            help='Number of processes used to generate start URLs. Defaults to 1.'
+        )
+        parser.add_argument(
+            '--batch_size',
+            type=int,
+            action='store',
+            default=DB_FETCH_BATCH_SIZE,
+            help='LinkedIn rows fetched from the database at a time.'
+        )
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            default=False,
+            help='Process every LinkedIn row, not only the ones added since the last run.'
+        )
+        args = parser.parse_args(sys.argv[2:])
 
-        # ? Load active spiders
+        # ? Load active spiders first, so the LinkedIn rows are routed while they are streamed
         logging.info('[!] Loading saved spiders.')
-        spiders = load_spiders_from_db(
+        spiders = load_spiders(
             self.SQL_QUERY_FOR_SPIDERS, self.DB_HOST, self.DB_USER, self.DB_PASS, self.DB_NAME
         )
-        comparing_publishers = load_publishers(self.PUBLISHERS_COMPARING_PATH)
+        domain_index = build_domain_index(spiders)
+
+        # ? Only the rows from the high-water mark of the previous run are processed. Rows equal
+        # ? to it are fetched again, as an update timestamp can be shared by rows of both runs,
+        # ? and their URLs are deduplicated against the ones saved by the previous run
+        watermarks = WatermarkStore()
+        watermark_column = self.LINKEDIN_WATERMARK_COLUMN
+        watermark = None if args.full else watermarks.get('monitor_data', watermark_column)
+        if watermark is not None:
+            logging.info('[!] Processing LinkedIn rows with {} from {}.'.format(
+                watermark_column, watermark
+            ))
+            sql = self.SQL_FOR_LINKEDIN_DB.format(
+                watermark_column, ' AND `{}` >= %s'.format(watermark_column)
+            )
+            sql_args = (watermark,)
+        else:
+            sql = self.SQL_FOR_LINKEDIN_DB.format(watermark_column, '')
+            sql_args = None
 
-        # ? Organize the URLs extracted from DB
+        # ? Organize the URLs extracted from DB, batch by batch. Only the rows matching a spider
+        # ? are kept; 0:company_name_in_linkedin, 1:company_domain, 2:example_job_posting,
+        # ? 3:watermark column
         organized_linkedin_urls_per_spider = dict()
-        for spider in spiders:
-            spider_publishers = list()
-            for url in urls:
-                if spider['main_domain'] in url['company_domain']:
-                    publisher = dict()
-                    publisher['company_name'] = url['company_name']
-                    publisher['start_url'] = url['example_job_posting']
-                    spider_publishers.append(publisher)
-            if any(spider_publishers):
-                organized_linkedin_urls_per_spider[spider['name']] = spider_publishers
+        high_water = None
+        try:
+            for rows in stream_rows_from_db(
+                    sql, self.DB_HOST, self.DB_USER, self.DB_PASS, self.DB_NAME,
+                    batch_size=args.batch_size, args=sql_args):
+                high_water = route_linkedin_rows(
+                    rows, domain_index, organized_linkedin_urls_per_spider, high_water
+                )
+        except Exception as e:
+            self.logger.info('[!] Error accesing to LinkedIn database.')
+            return
+        comparing_publishers = load_publishers(self.PUBLISHERS_COMPARING_PATH, spiders=spiders)
+
         # ? Generate start_urls from the organized URLs
-        start_urls = generate_start_urls(organized_linkedin_urls_per_spider, spiders)
+        preresolve_redirects(organized_linkedin_urls_per_spider, spiders)
+        start_urls = generate_start_urls(
+            organized_linkedin_urls_per_spider, spiders, workers=args.workers
+        )
         insert_new_urls_to_repo(
             start_urls, 
             comparing_publishers, 
-            from_action=self.main_args.action
+            from_action=self.main_args.action,
+            merge=watermark is not None
         )
+        # ? Moved only once the new URLs are saved, a failed run is processed again
+        if high_water is not None:
+            watermarks.set('monitor_data', watermark_column, high_water)
 
 
     def check_spider_urls(self):
+        from checking_url_tool import (
+            CHECK_CONCURRENCY, CHECK_MAX_BYTES, CHECK_PER_HOST, check_urls_integrity
+        )
+        from check_store import CheckStore
+        from start_urls_generation import (
+            generate_start_urls, insert_new_urls_to_repo, load_csv_file, load_publishers,
+            load_spiders, preresolve_redirects
+        )
         parser = argparse.ArgumentParser(
             description='Checks every URL in [<file_path>] looking for [<xpath>].',
-            usage='generate.py check_spider_urls [xpaths] [file]'
+            usage='generate.py check_spider_urls [xpaths] [file] [--concurrency] [--per_host] '\
+                '[--max_bytes] [--workers]'
         )
         parser.add_argument(
             '--xpaths', 
@@ -272,22 +397,58 @@ class Generate():
             type=str, 
             help='File containing spider\'s URLs.'
         )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            action='store',
+            default=CHECK_CONCURRENCY,
+            help='Max URLs checked at the same time.'
+        )
+        parser.add_argument(
+            '--per_host',
+            type=int,
+            action='store',
+            default=CHECK_PER_HOST,
+            help='Max URLs of the same host checked at the same time.'
+        )
+        parser.add_argument(
+            '--max_bytes',
+            type=int,
+            action='store',
+            default=CHECK_MAX_BYTES,
+            help='Max bytes downloaded per page when looking for the xpaths.'
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            action='store',
+            default=1,
+            help='Number of processes used to generate start URLs. Defaults to 1.'
+        )
         args = parser.parse_args(sys.argv[2:])
         spider_name = args.file_path.split('/')[-1].split('.')[0]
         spider_urls = load_csv_file(file_path=args.file_path, url_only=True)
         check_xpaths = args.xpaths.split('_|_')
-        check_urls_integrity({spider_name: spider_urls}, check_xpaths=check_xpaths)
+        check_urls_integrity(
+            {spider_name: spider_urls},
+            check_xpaths=check_xpaths,
+            concurrency=args.concurrency,
+            per_host=args.per_host,
+            store=CheckStore(),
+            max_bytes=args.max_bytes
+        )
         logging.info('[!] Loading input URLs and repo URLs')
-        spiders = load_spiders_from_db(
+        spiders = load_spiders(
             self.SQL_QUERY_FOR_SPIDERS, self.DB_HOST, self.DB_USER, self.DB_PASS, self.DB_NAME
         )
         spider_file = args.file_path.split('/')[-1]
         publishers = {spider_name: load_csv_file(self.PUBLISHERS_PATH+'/{}'.format(spider_file))}
-        comparing_publishers = load_publishers(self.PUBLISHERS_COMPARING_PATH)
+        comparing_publishers = load_publishers(self.PUBLISHERS_COMPARING_PATH, spiders=spiders)
 
         # Generate start_urls from input data
         logging.info('[!] Generating start URLs.')
-        start_urls = generate_start_urls(publishers, spiders)
+        preresolve_redirects(publishers, spiders)
+        start_urls = generate_start_urls(publishers, spiders, workers=args.workers)
 
         # Compare generated start_urls with urls already in the repo
         insert_new_urls_to_repo(start_urls, comparing_publishers, from_action=self.main_args.action)
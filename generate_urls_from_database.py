@@ -1,4 +1,4 @@
-import MySQLdb
+from scraping_common import create_mysql_connection_pool
 import urllib.parse as prs
 import os
 import pandas as pd
@@ -11,12 +11,17 @@ DB_HOST = os.getenv('DB_HOST')
 DB_USER = os.getenv('DB_USER')
 DB_PASS = os.getenv('DB_PASS')
 DB_NAME = os.getenv('DB_NAME')
-db = MySQLdb.connect(DB_HOST, DB_USER, DB_PASS, DB_NAME, use_unicode=True, charset='utf8')
+db_pool = create_mysql_connection_pool(
+    {'host': DB_HOST, 'user': DB_USER, 'password': DB_PASS, 'database': DB_NAME}
+)
+db = db_pool.getconn()
 cursor = db.cursor()
 subject = "my LinkedIn discover script"
 sql = "SELECT `company_name_in_linkedin`, `example_job_posting` FROM `monitor_data` WHERE `is_excluded`=0 ORDER BY `company_domain`"
 cursor.execute(sql)
 links = cursor.fetchall()
+cursor.close()
+db_pool.putconn(db)
 urls = []
 for row in links:
     # WARNING!!! don't add "wyworkday" links directly from LinkedIn
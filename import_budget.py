@@ -0,0 +1,120 @@
+import argparse
+import subprocess
+import sys
+
+
+# ? Modules imported by each generate.py action, max import time in ms and modules it must not
+# ? load. The budgets leave room for slower workers, the forbidden modules catch regressions
+# ? whatever the machine.
+HEAVY_MODULES = ('selenium', 'psycopg2', 'bs4', 'pandas', 'scrapy')
+IMPORT_BUDGETS = {
+    'generate': {
+        'modules': ['generate'],
+        'budget_ms': 150,
+        'forbidden': HEAVY_MODULES
+    },
+    'generate_from_google': {
+        'modules': [
+            'serp_scheduler', 'checkpoint_journal', 'checking_url_tool', 'check_store',
+            'start_urls_generation'
+        ],
+        'budget_ms': 1000,
+        # ? selenium is only loaded once a browser is started
+        'forbidden': HEAVY_MODULES
+    },
+    'generate_from_linkedin_db': {
+        'modules': ['start_urls_generation', 'ingestion_watermark'],
+        'budget_ms': 400,
+        'forbidden': HEAVY_MODULES
+    },
+    'check_spider_urls': {
+        'modules': ['checking_url_tool', 'check_store', 'start_urls_generation'],
+        'budget_ms': 500,
+        'forbidden': HEAVY_MODULES
+    }
+}
+
+
+def measure_import_time(modules):
+    """measure_import_time : Imports modules in a fresh interpreter with -X importtime.
+
+    Args:
+        modules (list): modules to import.
+
+    Returns:
+        tuple: (total import time in ms, set of the top level packages loaded)
+    """
+    p = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import {}'.format(', '.join(modules))],
+        stderr=subprocess.PIPE,
+        universal_newlines=True
+    )
+    if p.returncode != 0:
+        raise RuntimeError('Importing {} failed:\n{}'.format(', '.join(modules), p.stderr))
+    total_us = 0
+    loaded = set()
+    for line in p.stderr.splitlines():
+        # ? import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or line.endswith('imported package'):
+            continue
+        _, cumulative, package = line.split('|')
+        name = package.strip()
+        loaded.add(name.split('.')[0])
+        # ? Nested imports are indented, the cumulative time of top level ones includes them
+        if not package[1:].startswith(' '):
+            total_us += int(cumulative)
+    return total_us / 1000, loaded
+
+
+def check_import_budgets(actions, runs=3, scale=1.0):
+    """check_import_budgets : Checks the import time of every action against its budget.
+
+    Args:
+        actions (list): actions to check, keys of IMPORT_BUDGETS.
+        runs (int, optional): measures per action, the fastest one is kept. Defaults to 3.
+        scale (float, optional): multiplies every budget, for slow machines. Defaults to 1.0.
+
+    Returns:
+        list: failures as strings, empty when every action is within its budget.
+    """
+    failures = list()
+    for action in actions:
+        budget = IMPORT_BUDGETS[action]
+        elapsed, loaded = min(measure_import_time(budget['modules']) for _ in range(runs))
+        budget_ms = budget['budget_ms'] * scale
+        print('{}: {:.0f} ms (budget {:.0f} ms)'.format(action, elapsed, budget_ms))
+        if elapsed > budget_ms:
+            failures.append('{} imports in {:.0f} ms, over its {:.0f} ms budget'.format(
+                action, elapsed, budget_ms
+            ))
+        for module in sorted(loaded.intersection(budget['forbidden'])):
+            failures.append('{} loads {}'.format(action, module))
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Fails when the startup of a generate.py action regresses.'
+    )
+    parser.add_argument(
+        'actions', metavar='A', nargs='*', type=str,
+        help='Actions to check among {}. Defaults to all of them.'.format(
+            ', '.join(IMPORT_BUDGETS)
+        )
+    )
+    parser.add_argument('--runs', type=int, action='store', default=3)
+    parser.add_argument(
+        '--scale', type=float, action='store', default=1.0,
+        help='Multiplies every budget, e.g. 2 on a slow machine.'
+    )
+    args = parser.parse_args()
+    for action in args.actions:
+        if action not in IMPORT_BUDGETS:
+            parser.error('Unknown action: {}'.format(action))
+
+    failures = check_import_budgets(
+        args.actions or list(IMPORT_BUDGETS), runs=args.runs, scale=args.scale
+    )
+    for failure in failures:
+        print('[!] {}'.format(failure))
+    sys.exit(1 if any(failures) else 0)
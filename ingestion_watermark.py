@@ -0,0 +1,33 @@
+import time
+from sqlite_store import SqliteStore
+
+
+class WatermarkStore(SqliteStore):
+    """WatermarkStore : sqlite store of the high-water marks of incremental ingestions, i.e. the
+    highest value of the watermark column (primary key or update timestamp) already processed
+    for each source table. Values are kept as strings and compared by the database.
+
+    Args:
+        path (str, optional): path of the sqlite file. Defaults to the INGESTION_WATERMARK_PATH
+            environment variable, or ingestion_watermark.sqlite.
+    """
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS watermarks (source TEXT NOT NULL, col TEXT NOT NULL, '
+        'value TEXT NOT NULL, updated_at REAL NOT NULL, PRIMARY KEY (source, col))',
+    )
+    PATH_ENV = 'INGESTION_WATERMARK_PATH'
+    DEFAULT_PATH = 'ingestion_watermark.sqlite'
+
+    def get(self, source, col):
+        """get : Returns the watermark of source by col, None if it was never ingested."""
+        row = self.fetch_one(
+            'SELECT value FROM watermarks WHERE source = ? AND col = ?', (source, col)
+        )
+        return row[0] if row is not None else None
+
+    def set(self, source, col, value):
+        self.write(
+            'INSERT OR REPLACE INTO watermarks (source, col, value, updated_at) '
+            'VALUES (?, ?, ?, ?)',
+            (source, col, str(value), time.time())
+        )
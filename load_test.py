@@ -0,0 +1,484 @@
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import random
+import re
+import resource
+import sqlite3
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from MySQLdb.cursors import DictCursor
+
+import checking_url_tool
+import scraping_common
+import start_urls_generation
+from benchmarks import make_comparing_repo, make_publishers, make_spiders, write_publishers
+from repo_index import ComparingIndexStore
+from serp_extractor import HtmlSerpExtractor
+from serp_scheduler import SerpScheduler
+from sqlite_store import close_process_store, set_process_store
+
+
+# ? Same queries generate.py runs on spiders_on_recruitnet and monitor_data
+SQL_QUERY_FOR_SPIDERS = """
+    SELECT `id`, `name`, `main_domain`, `start_link_template`, `start_link_regexp`,
+        `ignored_subdomains`, `google_query`
+    FROM `spiders_on_recruitnet`
+    WHERE `is_ats_site`=1 AND `is_excluded`=0;
+"""
+SQL_FOR_LINKEDIN_DB = """
+    SELECT `company_name_in_linkedin`, `company_domain`, `example_job_posting`, `id`
+    FROM `monitor_data`
+    WHERE `is_excluded`=0
+    ORDER BY `company_domain`;
+"""
+CHECK_XPATHS = ['//div[@class="job"]']
+RESULTS_PER_PAGE = 10
+STAGES = ('queries', 'serp', 'check', 'linkedin', 'generate', 'diff')
+
+
+class FakeSerpHandler(BaseHTTPRequestHandler):
+    """FakeSerpHandler : Serves results pages shaped like the ones parse_serp_page and the SERP
+    extractor user script read: organic results under div#search div.rc, a "Next" link
+    (a#pnnext) on every page but the last one, and on the last page a "repeat the search with
+    the omitted results" link (#ofr) unless the search already includes them. Results point to
+    the fake ATS farm.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        params = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        query = params.get('q', [''])[0]
+        start = int(params.get('start', ['0'])[0] or 0)
+        omitted = 'filter' in params
+        domain = re.search(r'site:\*\.([\w.-]+)', query)
+        domain = domain.group(1) if domain is not None else 'unknown'
+        page = start // RESULTS_PER_PAGE
+        anchors = list()
+        for i in range(RESULTS_PER_PAGE):
+            n = start + i + (1000 if omitted else 0)
+            host = self.server.ats_hosts[n % len(self.server.ats_hosts)]
+            anchors.append(
+                '<div class="rc"><a href="http://{}/{}/company{}/jobs">Company {}</a></div>'
+                .format(host, domain, n, n)
+            )
+        links = ''
+        if page < self.server.pages - 1:
+            links += '<a id="pnnext" href="/search?q={}&start={}{}">Next</a>'.format(
+                urllib.parse.quote(query), start + RESULTS_PER_PAGE, '&filter=0' if omitted else ''
+            )
+        elif not omitted:
+            links += '<p id="ofr"><i><a href="/search?q={}&start=0&filter=0">repeat</a></i></p>'\
+                .format(urllib.parse.quote(query))
+        body = '<html><body><div id="search">{}</div>{}</body></html>'.format(
+            ''.join(anchors), links
+        ).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeAtsHandler(BaseHTTPRequestHandler):
+    """FakeAtsHandler : Career site of the fake ATS farm. Each path answers after the configured
+    latency with a jobs page, a server error or a redirect, drawn once per path so every run
+    sees the same site.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        path = urllib.parse.urlsplit(self.path).path
+        rnd = random.Random('{}{}'.format(self.server.seed, path))
+        time.sleep(self.server.latency * (0.5 + rnd.random()))
+        draw = rnd.random()
+        if 'redirected' not in self.path and draw < self.server.redirect_rate:
+            self.send_response(302)
+            self.send_header('Location', 'http://{}:{}{}?redirected=1'.format(
+                *self.server.server_address, path
+            ))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if draw < self.server.redirect_rate + self.server.error_rate:
+            body = b'<html><body>Internal Server Error</body></html>'
+            self.send_response(500)
+        else:
+            jobs = ''.join(
+                '<div class="job"><a href="{}/{}">Job {}</a></div>'.format(path, i, i)
+                for i in range(rnd.randint(0, 20))
+            )
+            body = '<html><body><h1>Careers</h1>{}</body></html>'.format(jobs).encode()
+            self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class QuietHTTPServer(ThreadingHTTPServer):
+    # ? The URL check drops connections once an xpath is found, that's not an error here
+    def handle_error(self, request, client_address):
+        pass
+
+
+def start_server(handler, **attributes):
+    """start_server : Starts a threaded HTTP server on a free local port.
+
+    Returns:
+        QuietHTTPServer: the running server, attributes are set on it for the handler.
+    """
+    server = QuietHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    for name, value in attributes.items():
+        setattr(server, name, value)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class FixtureCursor():
+    """FixtureCursor : sqlite cursor answering like the MySQLdb cursors used by the pipeline,
+    rows are dicts for a DictCursor."""
+
+    def __init__(self, cursor, as_dict=False):
+        self.cursor = cursor
+        if as_dict:
+            self.cursor.row_factory = lambda c, row: dict(
+                zip([column[0] for column in c.description], row)
+            )
+
+    def execute(self, query, args=None):
+        return self.cursor.execute(query.replace('%s', '?'), args or ())
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def fetchmany(self, size):
+        return tuple(self.cursor.fetchmany(size))
+
+    def close(self):
+        self.cursor.close()
+
+
+class FixtureConnection():
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+
+    def cursor(self, cursorclass=None):
+        return FixtureCursor(self.db.cursor(), as_dict=cursorclass is DictCursor)
+
+
+class FixtureConnectionPool():
+    """FixtureConnectionPool : Stand-in for MySQLConnectionPool over a sqlite copy of
+    spiders_on_recruitnet and monitor_data. Queries MySQL can't run on sqlite (CHECKSUM TABLE)
+    fail like an unreachable table would.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = FixtureConnection(self.path)
+        try:
+            yield conn
+        finally:
+            conn.db.close()
+
+
+def create_fixture_db(path, spiders, publishers):
+    """create_fixture_db : Creates the sqlite fixture with the spiders and one monitor_data row
+    per publisher."""
+    db = sqlite3.connect(path)
+    db.execute(
+        'CREATE TABLE spiders_on_recruitnet (id INTEGER PRIMARY KEY, name TEXT, main_domain TEXT, '
+        'start_link_template TEXT, start_link_regexp TEXT, ignored_subdomains TEXT, '
+        'google_query TEXT, is_ats_site INTEGER, is_excluded INTEGER)'
+    )
+    db.execute(
+        'CREATE TABLE monitor_data (id INTEGER PRIMARY KEY, company_name_in_linkedin TEXT, '
+        'company_domain TEXT, example_job_posting TEXT, is_excluded INTEGER)'
+    )
+    db.executemany(
+        'INSERT INTO spiders_on_recruitnet VALUES (?, ?, ?, ?, ?, ?, ?, 1, 0)',
+        [
+            (
+                spider['id'], spider['name'], spider['main_domain'],
+                spider['start_link_template'], spider['start_link_regexp'],
+                spider['ignored_subdomains'], spider['google_query']
+            )
+            for spider in spiders
+        ]
+    )
+    db.executemany(
+        'INSERT INTO monitor_data '
+        '(company_name_in_linkedin, company_domain, example_job_posting, is_excluded) '
+        'VALUES (?, ?, ?, 0)',
+        [
+            (
+                publisher.company_slug, urllib.parse.urlsplit(publisher.start_url).hostname,
+                publisher.start_url
+            )
+            for publishers_list in publishers.values() for publisher in publishers_list
+        ]
+    )
+    db.commit()
+    db.close()
+
+
+class StageStats():
+    """StageStats : Wall time, items and per-call latencies of a pipeline stage."""
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = list()
+        self.items = 0
+        self.elapsed = 0
+        self.peak_memory = None
+
+    def timed(self, function):
+        @wraps(function)
+        def timed_function(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.latencies.append(time.perf_counter() - start)
+        return timed_function
+
+    @contextlib.contextmanager
+    def running(self, trace_memory=False):
+        if trace_memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.elapsed = time.perf_counter() - start
+            if trace_memory:
+                self.peak_memory = tracemalloc.get_traced_memory()[1]
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        return {
+            'items': self.items,
+            'elapsed': self.elapsed,
+            'items_per_second': self.items / self.elapsed if self.elapsed else None,
+            'calls': len(latencies),
+            'p50': percentile(latencies, 50),
+            'p99': percentile(latencies, 99),
+            'peak_memory': self.peak_memory
+        }
+
+
+def percentile(values, p):
+    """percentile : Nearest-rank percentile of sorted values, None if there's no value."""
+    if not values:
+        return None
+    return values[max(0, -(-len(values) * p // 100) - 1)]
+
+
+@contextlib.contextmanager
+def patched(owner, name, replacement):
+    original = getattr(owner, name)
+    setattr(owner, name, replacement)
+    try:
+        yield original
+    finally:
+        setattr(owner, name, original)
+
+
+def run_pipeline(args, folder):
+    """run_pipeline : Runs every stage of generate_from_google and generate_from_linkedin_db
+    against the fake servers and the fixture database.
+
+    Returns:
+        dict: key:value pairs like stage:StageStats
+    """
+    rnd = random.Random(args.seed)
+    spiders = make_spiders(args.spiders, rnd)
+    publishers = make_publishers(spiders, args.publishers, rnd)
+    start_urls = start_urls_generation.generate_start_urls(publishers, spiders)
+    write_publishers(os.path.join(folder, 'publishers'), publishers)
+    write_publishers(
+        os.path.join(folder, 'comparing'), make_comparing_repo(start_urls, args.repo, rnd)
+    )
+    os.makedirs(os.path.join(folder, 'donotadd'))
+    os.makedirs(os.path.join(folder, 'new_urls', 'from_google'))
+    db_path = os.path.join(folder, 'fixture.sqlite')
+    create_fixture_db(db_path, spiders, publishers)
+    credentials = ('fixture', 'fixture', 'fixture', db_path)
+    scraping_common._MYSQL_CONNECTION_POOLS[credentials] = FixtureConnectionPool(db_path)
+
+    ats_farm = [
+        start_server(
+            FakeAtsHandler, latency=args.latency / 1000, error_rate=args.error_rate,
+            redirect_rate=args.redirect_rate, seed=args.seed
+        )
+        for _ in range(args.ats_hosts)
+    ]
+    serp = start_server(
+        FakeSerpHandler, pages=args.pages,
+        ats_hosts=['{}:{}'.format(*server.server_address) for server in ats_farm]
+    )
+    stats = {stage: StageStats(stage) for stage in STAGES}
+
+    with stats['queries'].running(args.trace_memory) as stage:
+        loaded_spiders = start_urls_generation.load_spiders(
+            SQL_QUERY_FOR_SPIDERS, *credentials,
+            snapshot_path=os.path.join(folder, 'spiders_snapshot.pkl')
+        )
+        queries = start_urls_generation.generate_google_query(
+            *credentials, ' site:*.{}', ' -site:{}.{}', spiders=loaded_spiders
+        )
+        stage.items = sum(len(spider_queries) for spider_queries in queries.values())
+
+    with stats['serp'].running(args.trace_memory) as stage, patched(
+            HtmlSerpExtractor, 'extract_query_urls',
+            stage.timed(HtmlSerpExtractor.extract_query_urls)):
+        scheduler = SerpScheduler(
+            browsers=args.browsers, queries_per_minute=args.queries_per_minute,
+            search_url='http://{}:{}/search'.format(*serp.server_address), backend='html'
+        )
+        spiders_urls = scheduler.run(queries, args.max_urls)
+        stage.items = sum(len(urls) for urls in spiders_urls.values())
+
+    with stats['check'].running(args.trace_memory) as stage, patched(
+            checking_url_tool, 'check_url', stage.timed(checking_url_tool.check_url)), \
+            contextlib.redirect_stdout(io.StringIO()):
+        checking_url_tool.check_urls_integrity(
+            spiders_urls, check_xpaths=CHECK_XPATHS, concurrency=args.concurrency,
+            per_host=args.per_host
+        )
+        stage.items = len(stage.latencies)
+
+    with stats['linkedin'].running(args.trace_memory) as stage:
+        domain_index = start_urls_generation.build_domain_index(loaded_spiders)
+        linkedin_publishers = dict()
+        batches = start_urls_generation.stream_rows_from_db(
+            SQL_FOR_LINKEDIN_DB, *credentials, batch_size=args.batch_size
+        )
+        # ? Same routing as generate_from_linkedin_db
+        route = stage.timed(start_urls_generation.route_linkedin_rows)
+        for rows in batches:
+            route(rows, domain_index, linkedin_publishers)
+            stage.items += len(rows)
+
+    with stats['generate'].running(args.trace_memory) as stage, patched(
+            start_urls_generation, 'generate_spider_start_urls',
+            stage.timed(start_urls_generation.generate_spider_start_urls)):
+        spiders_publishers = start_urls_generation.load_publishers(
+            os.path.join(folder, 'publishers'), spiders=loaded_spiders
+        )
+        start_urls = start_urls_generation.generate_start_urls(spiders_publishers, loaded_spiders)
+        stage.items = sum(len(urls) for urls in start_urls.values())
+
+    # ? The comparing index lives in the temporary folder, never at COMPARING_INDEX_PATH
+    set_process_store(ComparingIndexStore(os.path.join(folder, 'comparing_index.sqlite')))
+    with stats['diff'].running(args.trace_memory) as stage:
+        comparing_publishers = start_urls_generation.load_publishers(
+            os.path.join(folder, 'comparing'), spiders=loaded_spiders
+        )
+        insert = stage.timed(start_urls_generation.insert_new_urls_to_repo)
+        for spider_name, spider_start_urls in start_urls.items():
+            insert({spider_name: spider_start_urls}, comparing_publishers)
+            stage.items += len(spider_start_urls)
+
+    close_process_store(ComparingIndexStore)
+    for server in ats_farm + [serp]:
+        server.shutdown()
+    return stats
+
+
+def print_report(report):
+    print('{:<10} {:>8} {:>9} {:>10} {:>9} {:>9} {:>10}'.format(
+        'stage', 'items', 'time (s)', 'items/s', 'p50 (ms)', 'p99 (ms)', 'peak (MB)'
+    ))
+    for stage, summary in report['stages'].items():
+        print('{:<10} {:>8} {:>9.2f} {:>10} {:>9} {:>9} {:>10}'.format(
+            stage, summary['items'], summary['elapsed'],
+            '{:.0f}'.format(summary['items_per_second']) if summary['items_per_second'] else '-',
+            '{:.1f}'.format(summary['p50'] * 1000) if summary['p50'] is not None else '-',
+            '{:.1f}'.format(summary['p99'] * 1000) if summary['p99'] is not None else '-',
+            '{:.1f}'.format(summary['peak_memory'] / 2**20)
+            if summary['peak_memory'] is not None else '-'
+        ))
+    print('Pipeline: {:.2f}s, {:.0f} URLs/s, peak RSS {:.1f} MB'.format(
+        report['elapsed'], report['urls_per_second'], report['peak_rss'] / 2**20
+    ))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Runs the whole pipeline against a local fake SERP, a fake ATS farm and a '
+                    'sqlite fixture database, and reports its throughput.'
+    )
+    parser.add_argument('--spiders', type=int, action='store', default=20)
+    parser.add_argument('--publishers', type=int, action='store', default=500,
+                        help='Publishers per spider, also LinkedIn rows per spider.')
+    parser.add_argument('--repo', type=int, action='store', default=5000,
+                        help='Comparing repo URLs per spider.')
+    parser.add_argument('--pages', type=int, action='store', default=3,
+                        help='Results pages per query before the omitted results link.')
+    parser.add_argument('--max_urls', type=int, action='store', default=40)
+    parser.add_argument('--browsers', type=int, action='store', default=4)
+    parser.add_argument('--queries_per_minute', type=float, action='store', default=6000)
+    parser.add_argument('--ats_hosts', type=int, action='store', default=4)
+    parser.add_argument('--latency', type=float, action='store', default=50,
+                        help='Mean answer time of the ATS farm, in ms.')
+    parser.add_argument('--error_rate', type=float, action='store', default=0.05)
+    parser.add_argument('--redirect_rate', type=float, action='store', default=0.1)
+    parser.add_argument('--concurrency', type=int, action='store',
+                        default=checking_url_tool.CHECK_CONCURRENCY)
+    parser.add_argument('--per_host', type=int, action='store',
+                        default=checking_url_tool.CHECK_PER_HOST)
+    parser.add_argument('--batch_size', type=int, action='store',
+                        default=start_urls_generation.DB_FETCH_BATCH_SIZE)
+    parser.add_argument('--seed', type=int, action='store', default=0)
+    parser.add_argument('--trace_memory', action='store_true', default=False,
+                        help='Measure the peak Python memory of each stage (slower).')
+    parser.add_argument('--output', type=str, action='store', default=None,
+                        help='JSON file to save the report to.')
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    if args.trace_memory:
+        tracemalloc.start()
+    cwd = os.getcwd()
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)
+        try:
+            stats = run_pipeline(args, folder)
+        finally:
+            os.chdir(cwd)
+    elapsed = time.perf_counter() - start
+    urls = sum(stats[stage].items for stage in ('serp', 'check', 'generate', 'diff'))
+    report = {
+        'timestamp': time.time(),
+        'args': vars(args),
+        'elapsed': elapsed,
+        'urls_per_second': urls / elapsed,
+        # ? ru_maxrss is in KB on Linux
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'stages': {stage: stats[stage].summary() for stage in STAGES}
+    }
+    print_report(report)
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
@@ -0,0 +1,214 @@
+import json
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+try:
+    import resource
+except ImportError:
+    # ? Not available on Windows, peak memory is not reported there
+    resource = None
+
+
+# ? Paths are read from METRICS_SUMMARY_PATH and METRICS_TEXTFILE_PATH when exporting, after
+# ? generate.py loaded the .env file. The textfile is e.g. the node_exporter textfile collector
+# ? directory + '/start_urls.prom'
+DEFAULT_METRICS_SUMMARY_PATH = 'metrics.json'
+METRICS_PREFIX = 'start_urls_'
+# ? Upper bounds in seconds, from a single URL check to a whole stage
+HISTOGRAM_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600, math.inf)
+
+
+def get_peak_memory():
+    """get_peak_memory : Peak resident memory of the process in bytes, None if unknown."""
+    if resource is None:
+        return None
+    # ? ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class PipelineMetrics():
+    """PipelineMetrics : Thread-safe registry of the counters, timing histograms and gauges of a
+    run. Every metric is identified by its name and labels. The run is exported as a JSON
+    summary and as a Prometheus textfile.
+    """
+
+    def __init__(self, buckets=HISTOGRAM_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = dict()
+        self.histograms = dict()
+        self.gauges = dict()
+        self.started = time.time()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+                self.histograms[key] = histogram
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram['buckets'][i] += 1
+                    break
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @contextmanager
+    def stage(self, stage):
+        """stage : Times a pipeline stage and records the peak memory reached at its end."""
+        with self.timer('stage_duration_seconds', stage=stage):
+            yield
+        peak_memory = get_peak_memory()
+        if peak_memory is not None:
+            self.set('peak_memory_bytes', peak_memory, stage=stage)
+
+    def timed_stage(self, stage):
+        """timed_stage : Decorator timing every call of a function as a pipeline stage."""
+        def decorator(function):
+            @wraps(function)
+            def timed_function(*args, **kwargs):
+                with self.stage(stage):
+                    return function(*args, **kwargs)
+            return timed_function
+        return decorator
+
+    def summary(self):
+        """summary : Returns the metrics as a JSON serializable dict."""
+        def labeled(key):
+            name, labels = key
+            return {'name': name, 'labels': dict(labels)}
+
+        with self.lock:
+            return {
+                'started': self.started,
+                'finished': time.time(),
+                'counters': [
+                    dict(labeled(key), value=value) for key, value in sorted(self.counters.items())
+                ],
+                'gauges': [
+                    dict(labeled(key), value=value) for key, value in sorted(self.gauges.items())
+                ],
+                'histograms': [
+                    dict(
+                        labeled(key),
+                        count=histogram['count'],
+                        sum=histogram['sum'],
+                        buckets=dict(zip(
+                            [format_bound(bound) for bound in self.buckets],
+                            cumulative(histogram['buckets'])
+                        ))
+                    )
+                    for key, histogram in sorted(self.histograms.items())
+                ]
+            }
+
+    def to_prometheus(self, prefix=METRICS_PREFIX, **labels):
+        """to_prometheus : Returns the metrics in the Prometheus text exposition format. labels
+        are added to every sample, e.g. the action of the run."""
+        summary = self.summary()
+        lines = list()
+        typed = set()
+
+        def sample(name, metric_type, metric_labels, value):
+            if name not in typed:
+                lines.append('# TYPE {}{} {}'.format(prefix, name, metric_type))
+                typed.add(name)
+            lines.append('{}{}{} {}'.format(
+                prefix, name, format_labels(dict(labels, **metric_labels)), value
+            ))
+
+        for counter in summary['counters']:
+            sample(counter['name'], 'counter', counter['labels'], counter['value'])
+        for gauge in summary['gauges']:
+            sample(gauge['name'], 'gauge', gauge['labels'], gauge['value'])
+        for histogram in summary['histograms']:
+            name = histogram['name']
+            if name not in typed:
+                lines.append('# TYPE {}{} histogram'.format(prefix, name))
+                typed.add(name)
+            for bound, count in histogram['buckets'].items():
+                lines.append('{}{}_bucket{} {}'.format(
+                    prefix, name, format_labels(dict(labels, le=bound, **histogram['labels'])),
+                    count
+                ))
+            for suffix in ('sum', 'count'):
+                lines.append('{}{}_{}{} {}'.format(
+                    prefix, name, suffix, format_labels(dict(labels, **histogram['labels'])),
+                    histogram[suffix]
+                ))
+        sample('last_run_timestamp_seconds', 'gauge', dict(), summary['finished'])
+        return '\n'.join(lines) + '\n'
+
+    def export(self, summary_path=None, textfile_path=None, **labels):
+        """export : Writes the JSON summary and, if textfile_path is set, the Prometheus textfile.
+        Files are replaced atomically so a collector never reads a partial file. Paths default to
+        the METRICS_SUMMARY_PATH and METRICS_TEXTFILE_PATH environment variables."""
+        if summary_path is None:
+            summary_path = os.getenv('METRICS_SUMMARY_PATH', DEFAULT_METRICS_SUMMARY_PATH)
+        if textfile_path is None:
+            textfile_path = os.getenv('METRICS_TEXTFILE_PATH')
+        summary = self.summary()
+        summary['labels'] = labels
+        if summary_path:
+            write_atomically(summary_path, json.dumps(summary, indent=2))
+        if textfile_path:
+            write_atomically(textfile_path, self.to_prometheus(**labels))
+        logging.info('[!] Metrics saved to {}.'.format(
+            ', '.join(path for path in (summary_path, textfile_path) if path)
+        ))
+
+
+def cumulative(counts):
+    total = 0
+    result = list()
+    for count in counts:
+        total += count
+        result.append(total)
+    return result
+
+
+def format_bound(bound):
+    return '+Inf' if bound == math.inf else repr(float(bound))
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for key, value in sorted(labels.items())
+    ) + '}'
+
+
+def write_atomically(path, content):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as file:
+        file.write(content)
+    os.replace(temp_path, path)
+
+
+# ? Metrics of the current run, shared by every module of the pipeline
+METRICS = PipelineMetrics()
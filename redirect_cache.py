@@ -0,0 +1,110 @@
+import logging
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from sqlite_store import SqliteStore, get_process_store
+
+
+# ? Resolved redirects are kept for a week, failures are retried after an hour
+REDIRECT_CACHE_TTL = 7 * 24 * 3600
+REDIRECT_CACHE_NEGATIVE_TTL = 3600
+REDIRECT_TIMEOUT = 30
+
+
+class RedirectCache(SqliteStore):
+    """RedirectCache : sqlite backed cache of URL -> final URL after following redirects. Failed
+    resolutions are cached as well (negative caching) with a shorter TTL.
+
+    Args:
+        path (str, optional): path of the sqlite file. Defaults to the REDIRECT_CACHE_PATH
+            environment variable, or redirect_cache.sqlite.
+    """
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS redirects '
+        '(url TEXT PRIMARY KEY, final_url TEXT, resolved_at REAL NOT NULL)',
+    )
+    PATH_ENV = 'REDIRECT_CACHE_PATH'
+    DEFAULT_PATH = 'redirect_cache.sqlite'
+
+    def __init__(self, path=None, ttl=REDIRECT_CACHE_TTL,
+                 negative_ttl=REDIRECT_CACHE_NEGATIVE_TTL):
+        super().__init__(path)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+    def get(self, url):
+        """get : Looks up url in the cache.
+
+        Args:
+            url (str): URL to look up.
+
+        Returns:
+            tuple: (found, final_url). final_url is None for a cached failure.
+        """
+        row = self.fetch_one(
+            'SELECT final_url, resolved_at FROM redirects WHERE url = ?', (url,)
+        )
+        if row is None:
+            return False, None
+        final_url, resolved_at = row
+        ttl = self.ttl if final_url is not None else self.negative_ttl
+        if time.time() - resolved_at > ttl:
+            return False, None
+        return True, final_url
+
+    def set(self, url, final_url):
+        self.write(
+            'INSERT OR REPLACE INTO redirects (url, final_url, resolved_at) VALUES (?, ?, ?)',
+            (url, final_url, time.time())
+        )
+
+    def resolve(self, url, session=None):
+        """resolve : Returns the final URL of url after following its redirects, using the cache
+        when possible.
+
+        Args:
+            url (str): URL to resolve.
+            session (requests.Session, optional): session to reuse connections. Defaults to None.
+
+        Returns:
+            str: final URL, None if the URL could not be fetched.
+        """
+        found, final_url = self.get(url)
+        if found:
+            return final_url
+        try:
+            r = (session or requests).get(url, timeout=REDIRECT_TIMEOUT)
+            final_url = r.url
+        except Exception as e:
+            logging.info('[!] Error resolving redirects of {}: {}'.format(url, e))
+            final_url = None
+        self.set(url, final_url)
+        return final_url
+
+    def resolve_many(self, urls, max_workers=8):
+        """resolve_many : Resolves several URLs concurrently, at most max_workers at a time.
+        URLs already cached are not fetched again.
+
+        Args:
+            urls (iterable): URLs to resolve.
+            max_workers (int, optional): max concurrent requests. Defaults to 8.
+
+        Returns:
+            dict: key:value pairs like url:final_url
+        """
+        pending = [url for url in set(urls) if not self.get(url)[0]]
+        if any(pending):
+            logging.info('[!] Resolving redirects of {} URLs.'.format(len(pending)))
+            session = requests.Session()
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                list(executor.map(lambda url: self.resolve(url, session), pending))
+        return {url: self.get(url)[1] for url in urls}
+
+
+def get_redirect_cache():
+    """get_redirect_cache : Returns the RedirectCache of the current process."""
+    return get_process_store(RedirectCache)
+
+
+def resolve_redirect(url):
+    return get_redirect_cache().resolve(url)
@@ -0,0 +1,276 @@
+import hashlib
+from collections import OrderedDict, deque
+from sqlite_store import SqliteStore, get_process_store
+
+
+# ? Keeps the IN (...) lookups under the default sqlite limit of host parameters
+COMPARING_INDEX_LOOKUP_CHUNK = 500
+
+
+class AhoCorasick():
+    """AhoCorasick : Multi-pattern automaton that finds which of the given patterns occur in a text
+    with a single pass over the text.
+    """
+
+    def __init__(self, patterns):
+        self.goto = [dict()]
+        self.fail = [0]
+        self.output = [None]
+        self.dict_link = [0]
+        for pattern in patterns:
+            state = 0
+            for char in pattern:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto.append(dict())
+                    self.fail.append(0)
+                    self.output.append(None)
+                    self.dict_link.append(0)
+                    self.goto[state][char] = next_state
+                state = next_state
+            self.output[state] = pattern
+
+        # ? Breadth-first pass to set the failure links and the links to the nearest state (through
+        # ? failure links) that ends a pattern
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail_state = self.fail[state]
+                while fail_state and char not in self.goto[fail_state]:
+                    fail_state = self.fail[fail_state]
+                fail_state = self.goto[fail_state].get(char, 0)
+                self.fail[next_state] = fail_state
+                self.dict_link[next_state] = fail_state \
+                    if self.output[fail_state] is not None else self.dict_link[fail_state]
+
+    def find_in(self, text, found=None):
+        """find_in : Scans text and collects every pattern that occurs in it.
+
+        Args:
+            text (str): text to scan.
+            found (set, optional): set to add the patterns to. Defaults to None.
+
+        Returns:
+            set: patterns found in text.
+        """
+        found = set() if found is None else found
+        goto, fail, output, dict_link = self.goto, self.fail, self.output, self.dict_link
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            match_state = state if output[state] is not None else dict_link[state]
+            while match_state:
+                found.add(output[match_state])
+                match_state = dict_link[match_state]
+        return found
+
+
+class ComparingRepoIndex():
+    """ComparingRepoIndex : Index over the start URLs of one spider in the comparing repo. A URL is
+    known when it is equal to, or contained in, one of the repo URLs.
+    """
+
+    # ? Below this number of candidates a plain substring search over the joined repo text is
+    # ? cheaper than building an automaton
+    MIN_AUTOMATON_CANDIDATES = 32
+
+    def __init__(self, urls):
+        self.urls = set(urls)
+        # ? URLs never contain new lines, so a candidate found in the joined text is always
+        # ? contained in a single repo URL
+        self.text = '\n'.join(self.urls)
+
+    def known_urls(self, candidates):
+        """known_urls : Returns the candidates that are already in the repo, either as an exact
+        match or contained in an existing URL.
+
+        Args:
+            candidates (iterable): URLs to look for.
+
+        Returns:
+            set: subset of candidates already in the repo.
+        """
+        candidates = set(candidates)
+        known = self.exact_urls(candidates)
+        pending = [url for url in candidates - known if url]
+        if '' in candidates and not self.is_empty():
+            known.add('')
+        if not pending:
+            return known
+        text = self.get_text()
+        if len(pending) < self.MIN_AUTOMATON_CANDIDATES:
+            known.update(url for url in pending if url in text)
+            return known
+        return AhoCorasick(pending).find_in(text, known)
+
+    def exact_urls(self, candidates):
+        return candidates & self.urls
+
+    def is_empty(self):
+        return not self.urls
+
+    def get_text(self):
+        return self.text
+
+
+class StoredComparingIndex(ComparingRepoIndex):
+    """StoredComparingIndex : ComparingRepoIndex of one spider answered from a
+    ComparingIndexStore. Exact matches are looked up in the store and the joined repo text is
+    only read when some candidates are not exact matches.
+    """
+
+    def __init__(self, store, spider_name):
+        self.store = store
+        self.spider_name = spider_name
+
+    def exact_urls(self, candidates):
+        return self.store.exact_urls(self.spider_name, candidates)
+
+    def is_empty(self):
+        return self.store.count_urls(self.spider_name) == 0
+
+    def get_text(self):
+        return self.store.get_text(self.spider_name)
+
+
+class ComparingIndexStore(SqliteStore):
+    """ComparingIndexStore : Persistent sqlite index of the start URLs of the comparing repo, per
+    spider. A spider is re-indexed only when its file changed since it was indexed: files with the
+    same modification time and size are trusted, otherwise their content hash is compared.
+
+    Args:
+        path (str, optional): path of the sqlite file. Defaults to the COMPARING_INDEX_PATH
+            environment variable, or comparing_index.sqlite.
+    """
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS files (spider TEXT PRIMARY KEY, file_path TEXT NOT NULL, '
+        'mtime_ns INTEGER NOT NULL, size INTEGER NOT NULL, digest TEXT NOT NULL, '
+        'url_count INTEGER NOT NULL, text TEXT NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS urls (spider TEXT NOT NULL, url TEXT NOT NULL, '
+        'PRIMARY KEY (spider, url)) WITHOUT ROWID'
+    )
+    PATH_ENV = 'COMPARING_INDEX_PATH'
+    DEFAULT_PATH = 'comparing_index.sqlite'
+
+    def refresh(self, spider_name, comparing_publishers):
+        """refresh : Re-indexes the spider's comparing publishers if their file changed.
+
+        Args:
+            spider_name (str): name of the spider.
+            comparing_publishers (PublishersFolder): comparing repo folder.
+
+        Returns:
+            bool: True if the spider was re-indexed.
+        """
+        file_path, mtime_ns, size = comparing_publishers.source(spider_name)
+        row = self.fetch_one(
+            'SELECT file_path, mtime_ns, size, digest FROM files WHERE spider = ?', (spider_name,)
+        )
+        if row is not None and row[:3] == (file_path, mtime_ns, size):
+            return False
+        digest = hash_file(file_path)
+        if row is not None and row[0] == file_path and row[3] == digest:
+            # ? Touched but not modified, e.g. copied again by the sync job
+            self.write(
+                'UPDATE files SET mtime_ns = ?, size = ? WHERE spider = ?',
+                (mtime_ns, size, spider_name)
+            )
+            return False
+
+        urls = set(comparing_publishers.iter_urls(spider_name))
+        with self.transaction() as db:
+            db.execute('DELETE FROM urls WHERE spider = ?', (spider_name,))
+            db.executemany(
+                'INSERT INTO urls (spider, url) VALUES (?, ?)',
+                ((spider_name, url) for url in urls)
+            )
+            db.execute(
+                'INSERT OR REPLACE INTO files '
+                '(spider, file_path, mtime_ns, size, digest, url_count, text) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (spider_name, file_path, mtime_ns, size, digest, len(urls), '\n'.join(urls))
+            )
+        return True
+
+    def exact_urls(self, spider_name, candidates):
+        """exact_urls : Returns the candidates that are in the spider's comparing URLs."""
+        candidates = list(candidates)
+        known = set()
+        with self.lock:
+            for i in range(0, len(candidates), COMPARING_INDEX_LOOKUP_CHUNK):
+                chunk = candidates[i:i + COMPARING_INDEX_LOOKUP_CHUNK]
+                known.update(url for url, in self.db.execute(
+                    'SELECT url FROM urls WHERE spider = ? AND url IN ({})'.format(
+                        ', '.join('?' * len(chunk))
+                    ),
+                    [spider_name] + chunk
+                ))
+        return known
+
+    def count_urls(self, spider_name):
+        row = self.fetch_one('SELECT url_count FROM files WHERE spider = ?', (spider_name,))
+        return row[0] if row is not None else 0
+
+    def get_text(self, spider_name):
+        """get_text : Returns the spider's comparing URLs joined by new lines."""
+        row = self.fetch_one('SELECT text FROM files WHERE spider = ?', (spider_name,))
+        return row[0] if row is not None else ''
+
+    def get_index(self, spider_name, comparing_publishers):
+        """get_index : Refreshes the spider and returns its StoredComparingIndex."""
+        self.refresh(spider_name, comparing_publishers)
+        return StoredComparingIndex(self, spider_name)
+
+
+def hash_file(file_path):
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def get_comparing_index_store():
+    """get_comparing_index_store : Returns the ComparingIndexStore of the current process."""
+    return get_process_store(ComparingIndexStore)
+
+
+# ? In-memory indexes are kept for the last few spiders only, so memory does not grow with the
+# ? whole repo
+COMPARING_INDEXES_CACHE_SIZE = 8
+_COMPARING_INDEXES = OrderedDict()
+
+
+def get_comparing_index(spider_name, comparing_publishers):
+    """get_comparing_index : Returns the index of a spider's comparing start URLs. Folders of files
+    are indexed in the persistent ComparingIndexStore, re-indexing only the spiders whose file
+    changed. In-memory mappings are indexed in this process only, until they change.
+
+    Args:
+        spider_name (str): name of the spider.
+        comparing_publishers (Mapping): spider_name:publishers mapping of the comparing repo, a
+            dict of lists or a PublishersFolder.
+
+    Returns:
+        ComparingRepoIndex: index over the spider's comparing start URLs.
+    """
+    if hasattr(comparing_publishers, 'source'):
+        return get_comparing_index_store().get_index(spider_name, comparing_publishers)
+
+    source = comparing_publishers[spider_name]
+    cached = _COMPARING_INDEXES.get(spider_name)
+    if cached is not None and cached[0] is source:
+        _COMPARING_INDEXES.move_to_end(spider_name)
+        return cached[1]
+
+    comparing_index = ComparingRepoIndex(publisher.start_url for publisher in source)
+    _COMPARING_INDEXES[spider_name] = (source, comparing_index)
+    _COMPARING_INDEXES.move_to_end(spider_name)
+    while len(_COMPARING_INDEXES) > COMPARING_INDEXES_CACHE_SIZE:
+        _COMPARING_INDEXES.popitem(last=False)
+    return comparing_index
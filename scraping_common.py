@@ -1,4 +1,6 @@
+import os
 import pickle
+import queue
 import threading
 import random
 import datetime
@@ -7,23 +9,20 @@ import csv
 import requests
 import time
 import logging
-import psycopg2
-from psycopg2 import pool
-from bs4 import BeautifulSoup
+import MySQLdb
+from contextlib import contextmanager
 from sys import platform
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import NoSuchElementException
-from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
+from pipeline_metrics import METRICS
+# ? psycopg2, BeautifulSoup and selenium are imported by the functions using them, so the
+# ? actions that never open a browser don't pay for loading them
 
 logging.basicConfig(level=logging.INFO, 
-    format='%(process)d-%(levelname)s-%(message)s')
+    format='%(asctime)s %(process)d-%(levelname)s-%(message)s')
 
 def get_BeautifulSoup(url):
     '''Does a modified requests.get() and returns a BeautifulSoup object.
     '''
+    from bs4 import BeautifulSoup
     session = requests.session()
     r = session.get(url, headers={'user-agent':get_user_agent()})
 
@@ -33,6 +32,8 @@ def get_BeautifulSoup(url):
 def create_threaded_connection(database_credentials, maxconn):
     '''Creates a ThreadedConnectionPool with the database_credentials dict()
     '''
+    import psycopg2
+    from psycopg2 import pool
     # Connect to database using a ThreadedConnectionPool
     logger = get_logger('Database')
     threaded_connection_pool = None
@@ -56,12 +57,114 @@ def create_threaded_connection(database_credentials, maxconn):
     return threaded_connection_pool
 
 
+class MySQLConnectionPool():
+    """MySQLConnectionPool : Thread-safe pool of MySQLdb connections. Connections are checked with
+    ping() before being handed out and replaced when they are dead. A pool used after a fork
+    drops the connections inherited from the parent process and opens its own ones.
+    """
+
+    def __init__(self, database_credentials, maxconn=4, timeout=60):
+        self.database_credentials = database_credentials
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.idle = queue.LifoQueue()
+        self.created = 0
+
+    def _connect(self):
+        return MySQLdb.connect(
+            self.database_credentials['host'],
+            self.database_credentials['user'],
+            self.database_credentials['password'],
+            self.database_credentials['database'],
+            use_unicode=True,
+            charset='utf8'
+        )
+
+    def getconn(self):
+        """Returns a healthy connection, waiting for one to be returned if maxconn is reached."""
+        conn, create = (None, False)
+        with self.lock:
+            if self.pid != os.getpid():
+                self._reset()
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                if self.created < self.maxconn:
+                    self.created += 1
+                    create = True
+        if create:
+            try:
+                return self._connect()
+            except Exception:
+                with self.lock:
+                    self.created -= 1
+                raise
+        if conn is None:
+            conn = self.idle.get(timeout=self.timeout)
+        try:
+            conn.ping()
+        except Exception:
+            logging.info('[!] Replacing dead MySQL connection.')
+            try:
+                conn.close()
+            except Exception:
+                pass
+            try:
+                conn = self._connect()
+            except Exception:
+                with self.lock:
+                    self.created -= 1
+                raise
+        return conn
+
+    def putconn(self, conn):
+        if self.pid != os.getpid():
+            return
+        self.idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        """Context manager that takes a connection from the pool and gives it back afterwards."""
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def closeall(self):
+        with self.lock:
+            while not self.idle.empty():
+                self.idle.get_nowait().close()
+            self._reset()
+
+
+_MYSQL_CONNECTION_POOLS = dict()
+
+
+def create_mysql_connection_pool(database_credentials, maxconn=4):
+    '''Returns the MySQLConnectionPool shared by every caller using the same database_credentials
+    dict(). The pool is created on first use.
+    '''
+    key = tuple(database_credentials[k] for k in ('host', 'user', 'password', 'database'))
+    if key not in _MYSQL_CONNECTION_POOLS:
+        _MYSQL_CONNECTION_POOLS[key] = MySQLConnectionPool(database_credentials, maxconn)
+    return _MYSQL_CONNECTION_POOLS[key]
+
+
 def get_chromedriver(executable_path=None, cookies=None, proxy=None, user_agent=None, 
                         headless=False, images=False, fast_load=False):
     """Returns a Chrome WebDriver using proxies and user-agent if specified.
     """
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options
+    from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
     drive = None
-    chrome_options = webdriver.chrome.options.Options()
+    chrome_options = Options()
     if proxy is not None:
         chrome_options.add_argument('--proxy-server=%s' % proxy)
     if user_agent:
@@ -109,6 +212,7 @@ def get_user_agent():
 
 
 def extract_element_data(driver, xpath, retries=3):
+    from selenium.common.exceptions import NoSuchElementException
     data = None
     tries = 0
     extracted = False
@@ -175,28 +279,29 @@ def load_cookies(driver, filename):
 def get_webpage(driver, url, wait_for_element=None, wait_time= 10, retries=3, log_success=True):
     """Safely gets the URL with WebDriver.
     """
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
     tries = 0
     success = False
     while not success:
         try:
-            logging.info('{} - [!] Getting {}.'.format(get_formatted_time(), url))
+            logging.info('[!] Getting {}.'.format(url))
             driver.get(url)
             if wait_for_element is not None:
                 element = WebDriverWait(driver, wait_time)\
                     .until(EC.presence_of_element_located(
                         (By.XPATH, wait_for_element)))
-                logging.info('{} - [!] Element with xpath:{}. Loaded.'\
-                    .format(get_formatted_time(), wait_for_element))
+                logging.info('[!] Element with xpath:{}. Loaded.'.format(wait_for_element))
             if log_success:
-                logging.info('{} - [!] Success getting {}'\
-                    .format(get_formatted_time(), url))
+                logging.info('[!] Success getting {}'.format(url))
             success = True
             return success
         except Exception as e:
-            logging.info('{} - [!] Retrying {} due to {}'\
-                .format(get_formatted_time(), url, e))
+            logging.info('[!] Retrying {} due to {}'.format(url, e))
             if tries >= retries:
                 return success
+            METRICS.inc('browser_retries_total')
             tries += 1
             time.sleep(1)
 
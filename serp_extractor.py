@@ -0,0 +1,150 @@
+import argparse
+import glob
+import os
+import time
+import urllib.parse
+import requests
+from lxml import etree, html
+from scraping_common import get_user_agent
+
+
+SEARCH_URL = 'https://www.google.com/search'
+# ? Same expressions used by the SERP extractor user script and by go_to_next_page and
+# ? show_repeated_results, compiled once
+ORGANIC_RESULTS = etree.XPath("//div[@id='search']//div[@class='rc']//a/@href")
+NEXT_PAGE = etree.XPath('//a[@id="pnnext"]/@href')
+REPEATED_RESULTS = etree.XPath('//*[@id="ofr"]/i/a/@href')
+SERP_TIMEOUT = 30
+# ? Sanitized results pages, one with a "Next" link and one with the omitted results link
+SERP_FIXTURES = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'serp', '*.html'
+)
+
+
+class SerpBlocked(Exception):
+    """SerpBlocked : Raised when the search engine answers with its "sorry" block page."""
+
+
+def clean_hrefs(hrefs):
+    """clean_hrefs : Filters result links the same way the SERP extractor user script does,
+    dropping cached pages, Google links and relative links.
+
+    Args:
+        hrefs (list): raw href attributes.
+
+    Returns:
+        list: absolute result URLs.
+    """
+    urls = list()
+    for href in hrefs:
+        if href.startswith('//'):
+            href = 'https:' + href
+        if '.googleusercontent.com' in href:
+            continue
+        if '.google.com' in href and '.googleadservices.com' not in href:
+            continue
+        if not href.startswith('http'):
+            continue
+        urls.append(href)
+    return urls
+
+
+def parse_serp_page(page_html):
+    """parse_serp_page : Extracts the organic results and the pagination links of a results page.
+
+    Args:
+        page_html (str): HTML of the results page.
+
+    Returns:
+        tuple: (urls, next_page_href, repeated_results_href), the hrefs are None when missing.
+    """
+    tree = html.fromstring(page_html)
+    next_page = NEXT_PAGE(tree)
+    repeated_results = REPEATED_RESULTS(tree)
+    return (
+        clean_hrefs(ORGANIC_RESULTS(tree)),
+        next_page[0] if any(next_page) else None,
+        repeated_results[0] if any(repeated_results) else None
+    )
+
+
+class HtmlSerpExtractor():
+    """HtmlSerpExtractor : Browser-free extractor, fetches the raw results pages with requests and
+    parses them with lxml. It follows the "repeat with omitted results" link and the "Next" button
+    like the browser extractor does.
+
+    Args:
+        proxy (str, optional): proxy for the requests. Defaults to None.
+        search_url (str, optional): search endpoint. Defaults to SEARCH_URL.
+    """
+
+    def __init__(self, proxy=None, search_url=SEARCH_URL):
+        self.search_url = search_url
+        self.session = requests.Session()
+        self.session.headers['user-agent'] = get_user_agent()
+        if proxy is not None:
+            self.session.proxies = {'http': proxy, 'https': proxy}
+
+    def get_page(self, url, bucket):
+        bucket.acquire()
+        r = self.session.get(url, timeout=SERP_TIMEOUT)
+        if 'sorry' in r.url or r.status_code == 429:
+            raise SerpBlocked()
+        return r
+
+    def extract_query_urls(self, query, max_urls, deepnest, bucket):
+        """extract_query_urls : Loads the result pages of one query until max_urls is reached.
+
+        Returns:
+            list: URLs extracted from the organic results.
+        """
+        query = query.strip().replace(' ', '%20')
+        try:
+            r = self.get_page('{}?q={}&start={}'.format(self.search_url, query, deepnest), bucket)
+        except SerpBlocked:
+            raise
+        except Exception:
+            r = self.get_page('{}?q={}'.format(self.search_url, query), bucket)
+
+        urls = list()
+        visited = {r.url}
+        while True:
+            page_urls, next_page, repeated_results = parse_serp_page(r.text)
+            urls += page_urls
+            if len(urls) >= max_urls:
+                break
+            # ? Check if google hide links due to repetition, then if there's a "Next" button
+            link = repeated_results or next_page
+            if link is None or urllib.parse.urljoin(r.url, link) in visited:
+                break
+            r = self.get_page(urllib.parse.urljoin(r.url, link), bucket)
+            visited.add(r.url)
+        return urls
+
+    def close(self):
+        self.session.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks parse_serp_page on saved SERP pages')
+    parser.add_argument(
+        'pages', metavar='P', nargs='*', type=str,
+        help='Saved HTML pages. Defaults to the pages in fixtures/serp.'
+    )
+    parser.add_argument('--repeat', type=int, action='store', default=100)
+    args = parser.parse_args()
+    args.pages = args.pages or sorted(glob.glob(SERP_FIXTURES))
+
+    pages = list()
+    for path in args.pages:
+        with open(path, 'rb') as page:
+            pages.append(page.read())
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        results = [parse_serp_page(page) for page in pages]
+    elapsed = time.perf_counter() - start
+    for path, (urls, next_page, repeated_results) in zip(args.pages, results):
+        print('{}: {} URLs, next: {}, repeated: {}'.format(
+            path, len(urls), next_page is not None, repeated_results is not None
+        ))
+    print('{:.3f} ms per page'.format(elapsed * 1000 / (args.repeat * len(pages))))
@@ -0,0 +1,342 @@
+import logging
+import queue
+import threading
+import time
+from scraping_common import get_chromedriver, get_user_agent, get_webpage
+from serp_extractor import SEARCH_URL, HtmlSerpExtractor, SerpBlocked
+from pipeline_metrics import METRICS
+
+
+SERP_BACKENDS = ('browser', 'html')
+SERP_EXTRACTOR_JS_PATH = 'Internet Marketing Ninjas SERP Extractor User.js'
+RESULTS_XPATH = '//div[contains(@class, "rc")]'
+ORGANIC_RESULTS_XPATH = '//h2[contains(text(), "Organic Results")]/following-sibling::ol//li//a'
+# ? Default pace of every egress (browser proxy), in result pages per minute
+QUERIES_PER_MINUTE = 6
+MAX_QUERY_ATTEMPTS = 3
+MAX_JS_RETRIES = 10
+
+
+class SerpSchedulerError(Exception):
+    """SerpSchedulerError : Raised when some queries could not be performed, e.g. no browser could
+    be started or a query kept failing."""
+
+
+class TokenBucket():
+    """TokenBucket : Rate limiter shared by the browsers going out through the same egress. Every
+    page load takes a token. When the egress gets blocked the rate is halved and the bucket is
+    paused with an exponential backoff, successful pages bring the rate back to its base value.
+    """
+
+    def __init__(self, rate, capacity=1, min_backoff=60, max_backoff=1800):
+        self.base_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.backoff_pause = min_backoff
+        self.paused_until = 0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """acquire : Blocks until a token is available and takes it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                wait = self.paused_until - now
+                if wait <= 0 and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(wait, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def backoff(self):
+        """backoff : Slows the egress down after a block page."""
+        with self.lock:
+            self.rate = max(self.rate / 2, self.base_rate / 16)
+            self.tokens = 0
+            self.paused_until = time.monotonic() + self.backoff_pause
+            logging.info('[!] Egress blocked, pausing {}s.'.format(self.backoff_pause))
+            self.backoff_pause = min(self.backoff_pause * 2, self.max_backoff)
+
+    def success(self):
+        with self.lock:
+            self.rate = min(self.base_rate, self.rate + self.base_rate / 8)
+            self.backoff_pause = self.min_backoff
+
+
+class SerpScheduler():
+    """SerpScheduler : Runs the search queries of several spiders on a pool of browsers. Each
+    browser can go out through its own proxy, and the browsers sharing an egress share its
+    TokenBucket. Blocked or failed queries are retried later, up to MAX_QUERY_ATTEMPTS times.
+
+    Args:
+        browsers (int, optional): number of browsers. Defaults to 1.
+        proxies (list, optional): proxies assigned round-robin to the browsers. Defaults to None.
+        queries_per_minute (float, optional): pace of each egress. Defaults to QUERIES_PER_MINUTE.
+        search_url (str, optional): search endpoint, e.g. a local fake SERP with the html
+            backend. The user script only runs on google.com/search pages, so the browser backend
+            needs a Google endpoint. Defaults to SEARCH_URL.
+        headless (bool, optional): run the browsers headless. Defaults to False.
+        backend (str, optional): 'browser' drives Chrome with the SERP extractor user script,
+            'html' fetches and parses the raw pages with lxml. Defaults to 'browser'.
+    """
+
+    def __init__(self, browsers=1, proxies=None, queries_per_minute=QUERIES_PER_MINUTE,
+                 search_url=SEARCH_URL, headless=False, backend='browser'):
+        if backend not in SERP_BACKENDS:
+            raise ValueError('Unknown SERP backend: {}'.format(backend))
+        if backend == 'browser' and 'google.com/search' not in search_url:
+            raise ValueError('The browser backend only works on google.com/search, got {}'.format(
+                search_url
+            ))
+        self.browsers = browsers
+        self.proxies = proxies or [None]
+        self.search_url = search_url
+        self.headless = headless
+        self.backend = backend
+        self.buckets = {
+            proxy: TokenBucket(queries_per_minute / 60.0) for proxy in self.proxies
+        }
+        self.js = None
+        if backend == 'browser':
+            with open(SERP_EXTRACTOR_JS_PATH) as script:
+                self.js = script.read()
+
+    def create_extractor(self, proxy):
+        if self.backend == 'html':
+            return HtmlSerpExtractor(proxy=proxy, search_url=self.search_url)
+        return BrowserSerpExtractor(
+            self.js, proxy=proxy, search_url=self.search_url, headless=self.headless
+        )
+
+    def run(self, queries_dict, max_urls, deepnest=0, journal=None):
+        """run : Performs every query and extracts the result URLs.
+
+        Args:
+            queries_dict (dict): key:value pairs like spider_name:queries_list
+            max_urls (int): max number of URLs to collect per spider. Each query collects up to
+                max_urls, the merged results of a spider are cut to max_urls.
+            deepnest (int, optional): result offset to start from. Defaults to 0.
+            journal (CheckpointJournal, optional): journal to skip the queries already performed
+                and to record the new ones. Defaults to None.
+
+        Returns:
+            dict: key:value pairs like spider_name:urls, only for spiders with results.
+        """
+        tasks = queue.Queue()
+        results = dict()
+        # ? Results fetched with other limits or on another endpoint are not reused
+        params = {
+            'max_urls': max_urls, 'deepnest': deepnest, 'backend': self.backend,
+            'search_url': self.search_url
+        }
+        for spider_name, queries in queries_dict.items():
+            results[spider_name] = [list() for _ in queries]
+            for i, query in enumerate(queries):
+                urls = journal.get_query(spider_name, query, params) \
+                    if journal is not None else None
+                if urls is not None:
+                    logging.info('[!] Reusing results of a query for {}.'.format(spider_name))
+                    results[spider_name][i] = urls
+                    continue
+                tasks.put((spider_name, i, query, 1))
+
+        failures = list()
+        threads = list()
+        for n in range(min(self.browsers, tasks.qsize())):
+            proxy = self.proxies[n % len(self.proxies)]
+            thread = threading.Thread(
+                target=self._work,
+                args=(tasks, results, proxy, max_urls, deepnest, journal, params, failures)
+            )
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        # ? Left only when every browser failed to start
+        if not tasks.empty():
+            raise SerpSchedulerError('{} queries not performed, no browser could be started.'.format(
+                tasks.qsize()
+            ))
+        if any(failures):
+            raise SerpSchedulerError('{} queries failed after {} attempts: {}'.format(
+                len(failures), MAX_QUERY_ATTEMPTS, ', '.join(failures)
+            ))
+
+        # ? Results are merged in the order of the queries, whatever browser performed them, so
+        # ? the first queries of a spider fill its max_urls first
+        spiders_results = dict()
+        for spider_name, query_urls in results.items():
+            urls = [url for urls in query_urls for url in urls][:max_urls]
+            if any(urls):
+                spiders_results[spider_name] = urls
+        return spiders_results
+
+    def _work(self, tasks, results, proxy, max_urls, deepnest, journal, params, failures):
+        bucket = self.buckets[proxy]
+        extractor = None
+        try:
+            extractor = self.create_extractor(proxy)
+            while True:
+                try:
+                    spider_name, i, query, attempt = tasks.get(timeout=0.1)
+                except queue.Empty:
+                    # ? Another worker may still requeue the task it is performing
+                    if tasks.unfinished_tasks == 0:
+                        return
+                    continue
+                try:
+                    with METRICS.timer('serp_query_duration_seconds', backend=self.backend):
+                        results[spider_name][i] = extractor.extract_query_urls(
+                            query, max_urls, deepnest, bucket
+                        )
+                    bucket.success()
+                    METRICS.inc('serp_urls_total', len(results[spider_name][i]))
+                    if journal is not None:
+                        journal.save_query(
+                            spider_name, query, params, results[spider_name][i]
+                        )
+                except SerpBlocked:
+                    logging.info('[!] Blocked on query for {}.'.format(spider_name))
+                    METRICS.inc('serp_blocks_total', backend=self.backend)
+                    bucket.backoff()
+                    if attempt < MAX_QUERY_ATTEMPTS:
+                        tasks.put((spider_name, i, query, attempt + 1))
+                    else:
+                        failures.append('{}: {}'.format(spider_name, query))
+                except Exception as e:
+                    logging.info('[!] Error on query for {} (attempt {}): {!r}'.format(
+                        spider_name, attempt, e
+                    ))
+                    METRICS.inc('serp_errors_total', backend=self.backend)
+                    if attempt < MAX_QUERY_ATTEMPTS:
+                        tasks.put((spider_name, i, query, attempt + 1))
+                    else:
+                        failures.append('{}: {}'.format(spider_name, query))
+                finally:
+                    tasks.task_done()
+        except Exception as e:
+            logging.info('[!] Could not start a {} extractor: {!r}'.format(self.backend, e))
+        finally:
+            if extractor is not None:
+                extractor.close()
+
+
+class BrowserSerpExtractor():
+    """BrowserSerpExtractor : Extracts the results with a Chrome instance, injecting the SERP
+    extractor user script on every results page.
+    """
+
+    def __init__(self, js, proxy=None, search_url=SEARCH_URL, headless=False):
+        self.js = js
+        self.search_url = search_url
+        self.driver = get_chromedriver(
+            proxy=proxy,
+            user_agent=get_user_agent(),
+            headless=headless,
+            fast_load=True,
+            images=True
+        )
+
+    def extract_query_urls(self, query, max_urls, deepnest, bucket):
+        """extract_query_urls : Loads the result pages of one query, going through the "repeat with
+        omitted results" link and the "Next" button until max_urls is reached.
+
+        Returns:
+            list: URLs extracted from the organic results.
+        """
+        # ? selenium is only loaded by the browser backend
+        from selenium.common.exceptions import JavascriptException
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.webdriver.support import expected_conditions as EC
+
+        driver = self.driver
+        query = query.strip().replace(' ', '%20')
+        bucket.acquire()
+        try:
+            get_webpage(
+                driver=driver,
+                url='{}?q={}&start={}'.format(self.search_url, query, deepnest),
+                wait_for_element=RESULTS_XPATH
+            )
+        except Exception:
+            get_webpage(
+                driver=driver,
+                url='{}?q={}'.format(self.search_url, query),
+                wait_for_element=RESULTS_XPATH
+            )
+
+        urls = list()
+        js_retries = 0
+        while True:
+            if 'sorry' in driver.current_url:
+                raise SerpBlocked()
+            try:
+                driver.execute_script(self.js)
+                WebDriverWait(driver, 10).until(
+                    EC.presence_of_element_located((By.XPATH, ORGANIC_RESULTS_XPATH))
+                )
+            except Exception as e:
+                if not isinstance(e, JavascriptException) or js_retries >= MAX_JS_RETRIES:
+                    break
+                logging.info('[!] Error executing Javascript. Retrying...')
+                js_retries += 1
+                time.sleep(1)
+                continue
+            urls += [
+                anchor.get_attribute('href')
+                for anchor in driver.find_elements_by_xpath(ORGANIC_RESULTS_XPATH)
+            ]
+
+            # ? Check if google hide links due to repetition
+            if show_repeated_results(driver, urls, max_urls, throttle=bucket.acquire):
+                continue
+            # ? Check if there's a "Next" button
+            if go_to_next_page(driver, urls, max_urls, throttle=bucket.acquire):
+                continue
+            break
+        return urls
+
+    def close(self):
+        self.driver.close()
+
+
+def click_and_wait(driver, element, throttle):
+    """click_and_wait : Clicks a link once throttle() allows it and waits for the new page."""
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+
+    throttle()
+    element.click()
+    try:
+        WebDriverWait(driver, 10).until(EC.staleness_of(element))
+        WebDriverWait(driver, 10).until(
+            EC.presence_of_element_located((By.XPATH, RESULTS_XPATH))
+        )
+    except Exception:
+        logging.info('[!] Timeout waiting for the next results page.')
+
+
+def go_to_next_page(driver, urls, max_urls, throttle):
+    next_button = driver.find_elements_by_xpath('//a[@id="pnnext"]')
+    if any(next_button) and len(urls) < max_urls:
+        click_and_wait(driver, next_button[0], throttle)
+        return True
+    return False
+
+
+def show_repeated_results(driver, urls, max_urls, throttle):
+    repeat_with_all_results = driver.find_elements_by_xpath(
+        '//*[@id="ofr"]/i/a'
+    )
+    if any(repeat_with_all_results) and len(urls) < max_urls:
+        click_and_wait(driver, repeat_with_all_results[0], throttle)
+        return True
+    return False
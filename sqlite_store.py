@@ -0,0 +1,88 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+class SqliteStore():
+    """SqliteStore : Base of the sqlite backed stores (redirect cache, check store, journal...).
+    A store holds one connection shared by the threads of a process behind self.lock and creates
+    its tables when opened. Without an explicit path, the file is the one named by the PATH_ENV
+    environment variable, read when the store is opened so values loaded from .env apply, or
+    DEFAULT_PATH.
+
+    Args:
+        path (str, optional): path of the sqlite file. Defaults to None.
+    """
+    # ? CREATE statements of the store tables
+    SCHEMA = ()
+    PATH_ENV = None
+    DEFAULT_PATH = None
+
+    def __init__(self, path=None):
+        self.path = path or os.getenv(self.PATH_ENV, self.DEFAULT_PATH)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        with self.transaction():
+            self.migrate()
+            for statement in self.SCHEMA:
+                self.db.execute(statement)
+
+    def migrate(self):
+        """migrate : Called before the tables are created, to adapt files written by an older
+        version of the store. Runs with the lock held."""
+
+    @contextmanager
+    def transaction(self):
+        """transaction : Holds the lock and commits the statements run on self.db, or rolls them
+        back on error."""
+        with self.lock:
+            try:
+                yield self.db
+            except Exception:
+                self.db.rollback()
+                raise
+            self.db.commit()
+
+    def fetch_one(self, sql, args=()):
+        with self.lock:
+            return self.db.execute(sql, args).fetchone()
+
+    def fetch_all(self, sql, args=()):
+        with self.lock:
+            return self.db.execute(sql, args).fetchall()
+
+    def write(self, sql, args=()):
+        with self.transaction() as db:
+            db.execute(sql, args)
+
+
+_PROCESS_STORES = dict()
+_PROCESS_STORES_LOCK = threading.Lock()
+
+
+def get_process_store(store_class):
+    """get_process_store : Returns the store of store_class for the current process, opening it
+    at its default path on first use. sqlite connections can't be shared with the processes of a
+    pool, each one opens its own.
+    """
+    key = (os.getpid(), store_class)
+    with _PROCESS_STORES_LOCK:
+        if key not in _PROCESS_STORES:
+            _PROCESS_STORES[key] = store_class()
+        return _PROCESS_STORES[key]
+
+
+def set_process_store(store):
+    """set_process_store : Makes store the store of its class for the current process, e.g. one
+    in a temporary folder for the benchmarks and the load test."""
+    with _PROCESS_STORES_LOCK:
+        _PROCESS_STORES[(os.getpid(), type(store))] = store
+
+
+def close_process_store(store_class):
+    """close_process_store : Closes and forgets the store of store_class of the current process."""
+    with _PROCESS_STORES_LOCK:
+        store = _PROCESS_STORES.pop((os.getpid(), store_class), None)
+    if store is not None:
+        store.db.close()
@@ -1,22 +1,36 @@
-import argparse
-from logging import Logger
-from selenium.common.exceptions import JavascriptException
-from checking_url_tool import check_urls_integrity
-from os import sep
-import MySQLdb
 import logging
 import os
 import re
-import time
-import json
-import random
+import sys
+import pickle
+import queue
+import threading
 import urllib.parse
-from dotenv import load_dotenv, find_dotenv
-from MySQLdb.cursors import DictCursor
-from pandas import DataFrame
-from scraping_common import *
+from MySQLdb.cursors import DictCursor, SSCursor
+from scraping_common import create_mysql_connection_pool
 from urllib.parse import urlparse
-import start_urls_generation
+from repo_index import get_comparing_index
+from redirect_cache import get_redirect_cache, resolve_redirect
+from pipeline_metrics import METRICS
+from columnar_publishers import COLUMNAR_EXTENSION, iter_columnar_file
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from collections.abc import Mapping
+
+
+SPIDERS_SNAPSHOT_PATH = os.getenv('SPIDERS_SNAPSHOT_PATH', 'spiders_snapshot.pkl')
+# ? CHECKSUM TABLE still reads the whole table on the server, but only one row comes back and
+# ? nothing is compiled when it matches. information_schema.TABLES.UPDATE_TIME would be cheaper
+# ? but is unreliable on InnoDB: NULL after a restart and cached for up to
+# ? information_schema_stats_expiry (a day by default on MySQL 8), so edits could be missed.
+SQL_QUERY_FOR_SPIDERS_CHECKSUM = 'CHECKSUM TABLE `spiders_on_recruitnet`;'
+# ? Rows fetched at a time by stream_rows_from_db
+DB_FETCH_BATCH_SIZE = 5000
+
+# ? Per spider counters of publishers matched by start_link_regexp, publishers that needed
+# ? to go through rearrange_publisher_url first and publishers that never matched.
+START_LINK_REGEXP_STATS = defaultdict(lambda: {'hits': 0, 'rearranged': 0, 'misses': 0})
 
 
 def load_spiders_from_db(query, db_host='127.0.0.1', db_user='root', db_pass='pass', db_name='db'):
@@ -32,81 +46,344 @@ def load_spiders_from_db(query, db_host='127.0.0.1', db_user='root', db_pass='pa
     Returns:
         list: list() object containing dict objects from the query.
     """
+    results = fetch_rows_from_db(query, db_host, db_user, db_pass, db_name)
+    return compile_spiders_regexps(results)
 
+
+def fetch_rows_from_db(query, db_host='127.0.0.1', db_user='root', db_pass='pass', db_name='db'):
+    """fetch_rows_from_db : Makes a query to the database and returns its rows as dicts. Errors
+    are logged and an empty list is returned.
+    """
     results = list()
-    db, cursor = (None, None)
+    db_pool = get_mysql_connection_pool(db_host, db_user, db_pass, db_name)
 
     try:
-        db = MySQLdb.connect(db_host, db_user, db_pass, db_name, use_unicode=True, charset='utf8')
-        cursor = db.cursor(DictCursor)
-        cursor.execute(query)
-        results = cursor.fetchall()
+        with db_pool.connection() as db:
+            cursor = db.cursor(DictCursor)
+            try:
+                cursor.execute(query)
+                results = cursor.fetchall()
+            finally:
+                cursor.close()
     except Exception as identifier:
         logging.info('[!] Error making query to database: {}'.format(identifier))
-    finally:
-        if db is not None and cursor is not None:
-            cursor.close()
-            db.close()
 
     return results
 
 
-def load_publishers(publishers_path=None, file_path=None):
-    """load_publishers : Reads all of the CSV files in PUBLISHERS_PATH (not checked yet) 
-    and generates a list() object with several dict() objects in the following structure:
+def stream_rows_from_db(query, db_host='127.0.0.1', db_user='root', db_pass='pass', db_name='db',
+                        batch_size=DB_FETCH_BATCH_SIZE, args=None):
+    """stream_rows_from_db : Streams the rows of query through an unbuffered server-side cursor
+    (SSCursor), batch_size rows at a time, so the result set is never held in memory. A thread
+    fetches the next batch while the caller processes the current one. Unlike
+    fetch_rows_from_db, errors are raised.
+
+    Args:
+        query (str): query to execute.
+        batch_size (int, optional): rows per batch. Defaults to DB_FETCH_BATCH_SIZE.
+        args (tuple, optional): parameters of the query. Defaults to None.
+
+    Yields:
+        tuple: batch of rows.
+    """
+    db_pool = get_mysql_connection_pool(db_host, db_user, db_pass, db_name)
+    # ? At most one batch waits while the caller processes another one
+    batches = queue.Queue(maxsize=1)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch():
+        try:
+            with db_pool.connection() as db:
+                cursor = db.cursor(SSCursor)
+                try:
+                    cursor.execute(query, args)
+                    while True:
+                        rows = cursor.fetchmany(batch_size)
+                        if not put(rows) or not rows:
+                            break
+                finally:
+                    # ? The rows left unread are discarded, the connection can be reused
+                    cursor.close()
+        except Exception as e:
+            put(e)
+
+    fetcher = threading.Thread(target=fetch, daemon=True)
+    fetcher.start()
+    try:
+        while True:
+            rows = batches.get()
+            if isinstance(rows, Exception):
+                raise rows
+            if not rows:
+                break
+            yield rows
+    finally:
+        stop.set()
+        fetcher.join()
+
+
+def get_mysql_connection_pool(db_host, db_user, db_pass, db_name):
+    """get_mysql_connection_pool : Returns the connection pool shared by every stage of an action
+    for the given database.
+    """
+    return create_mysql_connection_pool(
+        {'host': db_host, 'user': db_user, 'password': db_pass, 'database': db_name}
+    )
+
+
+def load_spiders(query, db_host='127.0.0.1', db_user='root', db_pass='pass', db_name='db',
+                 snapshot_path=SPIDERS_SNAPSHOT_PATH):
+    """load_spiders : Loads the spiders from a local snapshot of the spiders table, with the
+    regexps already compiled and the domain index built. The snapshot is only used while the
+    table checksum did not change, otherwise the spiders are reloaded with load_spiders_from_db
+    and the snapshot is rewritten. If the database can't be reached the snapshot is used as is.
+
+    Args:
+        query (str): query used to load the spiders.
+        snapshot_path (str, optional): path of the snapshot file. Defaults to
+            SPIDERS_SNAPSHOT_PATH.
+
+    Returns:
+        SpidersList: list of spiders.
+    """
+    snapshot = None
+    try:
+        with open(snapshot_path, 'rb') as snapshot_file:
+            snapshot = pickle.load(snapshot_file)
+        # ? Snapshots written before rejected spiders were kept would miss their queries
+        if snapshot['query'] != query or not hasattr(snapshot['spiders'], 'rejected'):
+            snapshot = None
+    except (OSError, pickle.UnpicklingError, EOFError, KeyError, AttributeError, TypeError):
+        snapshot = None
+
+    checksum = None
+    rows = fetch_rows_from_db(SQL_QUERY_FOR_SPIDERS_CHECKSUM, db_host, db_user, db_pass, db_name)
+    if any(rows):
+        checksum = rows[0]['Checksum']
+    if snapshot is not None and (checksum is None or snapshot['checksum'] == checksum):
+        if checksum is None:
+            logging.info('[!] Could not check the spiders table, using the local snapshot.')
+        return snapshot['spiders']
+
+    spiders = load_spiders_from_db(query, db_host, db_user, db_pass, db_name)
+    if checksum is not None and any(spiders):
+        temp_path = snapshot_path + '.tmp'
+        with open(temp_path, 'wb') as snapshot_file:
+            pickle.dump(
+                {'query': query, 'checksum': checksum, 'spiders': spiders},
+                snapshot_file,
+                protocol=pickle.HIGHEST_PROTOCOL
+            )
+        os.replace(temp_path, snapshot_path)
+    return spiders
+
+
+class SpidersList(list):
+    """SpidersList : list of spiders that carries its domain index, so it is built only once. The
+    spiders rejected by compile_spiders_regexps are kept apart in rejected, they can't generate
+    start URLs but their Google queries are still made.
+    """
+
+    def __init__(self, spiders=(), rejected=()):
+        super().__init__(spiders)
+        self.rejected = list(rejected)
+        self.domain_index = None
+        self.domain_index = build_domain_index(self)
+
+
+def compile_spiders_regexps(spiders):
+    """compile_spiders_regexps : Compiles the start_link_regexp of each spider once and stores it
+    under the 'start_link_pattern' key. Spiders with an invalid start_link_regexp are rejected here
+    instead of failing in the middle of generate_start_urls.
+
+    Args:
+        spiders (list): list of spiders as returned by the database.
+
+    Returns:
+        SpidersList: spiders with a valid (or empty) start_link_regexp.
+    """
+    compiled_spiders = list()
+    rejected_spiders = list()
+    for spider in spiders:
+        spider['start_link_pattern'] = None
+        if spider['start_link_regexp'] is not None:
+            try:
+                spider['start_link_pattern'] = re.compile(spider['start_link_regexp'])
+            except re.error as e:
+                logging.info('[!] Rejecting spider {}, invalid start_link_regexp: {}'.format(
+                    spider['name'], e
+                ))
+                rejected_spiders.append(spider)
+                continue
+        compiled_spiders.append(spider)
+    return SpidersList(compiled_spiders, rejected=rejected_spiders)
+
+
+def load_publishers(publishers_path=None, file_path=None, spiders=None):
+    """load_publishers : Indexes the CSV files in PUBLISHERS_PATH (not checked yet) and returns a
+    lazy mapping with the following structure:
 
     {
-        "spider_name": [
-            {
-                "company_slug": "slug",
-                "company_name": "name",
-                "start_url": "URL"
-            }
-        ]
+        "spider_name": <publishers generator>
     }
 
+    where each publisher is a Publisher record (company_slug, company_name, start_url).
+
+    Files are only read when their spider is accessed, one at a time. A spider_name.pubcol file
+    (see columnar_publishers.py) is read instead of the CSV file when it's at least as recent.
+
     Args:
         publishers_path (str): Path to the folder that contains the CSV files.
+        spiders (list, optional): active spiders; files without an active spider are skipped.
+            Defaults to None (keep every file).
 
     Returns:
-        list: list of dicts that represents each spider, each one of these dict objects
-        contains a list with all the publishers for that spider.
+        PublishersFolder: mapping of spider_name:publishers generator.
     """
-    # Iterate over all of the CSV files
     if file_path is None:
-        publishers = dict()
-        for file_name in os.listdir(publishers_path):
-            if file_name.endswith('.csv'):
-                # Load the content of the CSV file
-                file_path = publishers_path + '/' + file_name
-                publishers[file_name.replace('.csv', '')] = load_csv_file(file_path)
-        return publishers
+        return PublishersFolder(publishers_path, spiders=spiders)
     # ? Case of use: load publishers for only one spider
     # return load_csv_format(file_path)
 
 
+class PublishersFolder(Mapping):
+    """PublishersFolder : Read-only mapping over a folder of per-spider CSV or columnar files.
+    Accessing a spider streams the rows of its file instead of keeping the whole folder in memory.
+    """
+
+    def __init__(self, publishers_path, spiders=None):
+        self.publishers_path = publishers_path
+        self.files = dict()
+        domain_index = build_domain_index(spiders) if spiders is not None else None
+        file_names = set(os.listdir(publishers_path))
+        for file_name in sorted(file_names):
+            if not file_name.endswith('.csv') and not file_name.endswith(COLUMNAR_EXTENSION):
+                continue
+            spider_name = os.path.splitext(file_name)[0]
+            if spider_name in self.files:
+                continue
+            if spiders is not None and find_spider_by_name(
+                    spider_name.replace('_', '.'), spiders, domain_index) is None:
+                continue
+            self.files[spider_name] = self.pick_file(spider_name, file_names)
+
+    def pick_file(self, spider_name, file_names):
+        """pick_file : Returns the path of the file to read for a spider, its columnar file unless
+        the CSV file was modified after it."""
+        csv_path = self.publishers_path + '/' + spider_name + '.csv'
+        columnar_path = self.publishers_path + '/' + spider_name + COLUMNAR_EXTENSION
+        if spider_name + COLUMNAR_EXTENSION not in file_names:
+            return csv_path
+        if spider_name + '.csv' in file_names and \
+                os.stat(csv_path).st_mtime_ns > os.stat(columnar_path).st_mtime_ns:
+            return csv_path
+        return columnar_path
+
+    def __getitem__(self, spider_name):
+        file_path = self.files[spider_name]
+        if file_path.endswith(COLUMNAR_EXTENSION):
+            return (
+                Publisher(company_name, start_url, company_slug=company_slug)
+                for company_slug, company_name, start_url in iter_columnar_file(file_path)
+            )
+        return iter_csv_file(file_path)
+
+    def __iter__(self):
+        return iter(self.files)
+
+    def __len__(self):
+        return len(self.files)
+
+    def iter_urls(self, spider_name):
+        """iter_urls : Streams only the start URLs of a spider file."""
+        file_path = self.files[spider_name]
+        if file_path.endswith(COLUMNAR_EXTENSION):
+            return iter_columnar_file(file_path, columns=('start_url',))
+        return iter_csv_file(file_path, url_only=True)
+
+    def source(self, spider_name):
+        """source : Identifies the current content of a spider file, used to reuse indexes built
+        over it while the file does not change."""
+        stat = os.stat(self.files[spider_name])
+        return (self.files[spider_name], stat.st_mtime_ns, stat.st_size)
+
+
+class Publisher():
+    """Publisher : Compact record of a publisher. Slots instead of a per-instance dict, and
+    interned company names and slugs, so the same company found in several files or spiders is
+    stored once. Records are not modified by the pipeline, stages build new ones.
+
+    Args:
+        company_name (str): name of the company.
+        start_url (str): URL of the publisher.
+        company_slug (str, optional): slug of the company. Defaults to ''.
+    """
+    __slots__ = ('company_slug', 'company_name', 'start_url')
+
+    def __init__(self, company_name, start_url, company_slug=''):
+        self.company_slug = sys.intern(company_slug)
+        self.company_name = sys.intern(company_name)
+        self.start_url = start_url
+
+    def with_start_url(self, start_url):
+        """with_start_url : Returns a copy of the record with another start_url."""
+        publisher = Publisher.__new__(Publisher)
+        publisher.company_slug = self.company_slug
+        publisher.company_name = self.company_name
+        publisher.start_url = start_url
+        return publisher
+
+    def __repr__(self):
+        return 'Publisher({!r}, {!r}, company_slug={!r})'.format(
+            self.company_name, self.start_url, self.company_slug
+        )
+
+    # ? Records go through the process pool
+    def __getstate__(self):
+        return (self.company_slug, self.company_name, self.start_url)
+
+    def __setstate__(self, state):
+        self.company_slug = sys.intern(state[0])
+        self.company_name = sys.intern(state[1])
+        self.start_url = state[2]
+
+
 def load_csv_file(file_path, url_only=False):
-    spider_publishers = list()
-    if os.stat(file_path).st_size != 0:
-        with open(file_path, 'r') as file:
-            for line in file:
-                fields = line.strip().split('\t') \
-                    if '\t' in line else line.strip().split()
-                if url_only:
-                    line_dict = fields[-1]
-                    spider_publishers.append(line_dict)
-                    continue
-                line_dict = {
-                    'company_slug': '',
-                    'company_name': fields[0],
-                    'start_url': fields[-1]
-                } if len(fields) == 2 else {
-                        'company_slug': fields[0],
-                        'company_name': fields[1],
-                        'start_url': fields[-1]
-                    }
-                spider_publishers.append(line_dict)
-    return spider_publishers
+    return list(iter_csv_file(file_path, url_only=url_only))
+
+
+def iter_csv_file(file_path, url_only=False):
+    """iter_csv_file : Streams the publishers of a tab or space separated file. Lines with two
+    fields have no company_slug. With url_only only the start URL of each line is yielded and no
+    record is built.
+
+    Args:
+        file_path (str): path to the spider file.
+        url_only (bool, optional): yield only the start URLs. Defaults to False.
+
+    Yields:
+        Publisher or str: publisher record, or its start URL when url_only is True.
+    """
+    with open(file_path, 'r') as file:
+        for line in file:
+            fields = line.strip().split('\t') \
+                if '\t' in line else line.strip().split()
+            if not fields:
+                continue
+            if url_only:
+                yield fields[-1]
+                continue
+            yield Publisher(fields[0], fields[-1]) if len(fields) == 2 else \
+                Publisher(fields[1], fields[-1], company_slug=fields[0])
 
 
 def extract_domain_from_url(url):
@@ -121,23 +398,101 @@ def extract_domain_from_url(url):
     return urllib.parse.urlparse(url).netloc
 
 
-def find_spider_by_name(name, spiders):
-    """find_spider_by_name : Iterates over a list of dict objects until it find one with the name
-    given as an input.
+def build_domain_index(spiders):
+    """build_domain_index : Builds a suffix map from each spider's main_domain to the spiders that
+    own it, so a host can be resolved by walking its labels instead of scanning every spider.
+
+    Args:
+        spiders (list): list of spiders as returned by load_spiders_from_db.
+
+    Returns:
+        dict: key:value pairs like main_domain:spiders_list
+    """
+    if getattr(spiders, 'domain_index', None) is not None:
+        return spiders.domain_index
+    domain_index = dict()
+    for spider in spiders:
+        if not spider['main_domain']:
+            continue
+        domain = spider['main_domain'].strip().strip('.').lower()
+        domain_index.setdefault(domain, list()).append(spider)
+    return domain_index
+
+
+def find_spiders_by_domain(host, domain_index):
+    """find_spiders_by_domain : Walks the labels of host from the most specific suffix to the least
+    specific one and collects every spider whose main_domain is one of those suffixes.
+
+    Args:
+        host (str): host (or full URL) to resolve, e.g. 'acme.wd5.myworkdayjobs.com'.
+        domain_index (dict): index built with build_domain_index.
+
+    Returns:
+        list: spiders whose main_domain is a suffix of host.
+    """
+    if not host:
+        return list()
+    if '://' in host:
+        host = extract_domain_from_url(host)
+    labels = host.split(':')[0].strip().strip('.').lower().split('.')
+    spiders = list()
+    for i in range(len(labels)):
+        spiders += domain_index.get('.'.join(labels[i:]), [])
+    return spiders
+
+
+def route_linkedin_rows(rows, domain_index, publishers_per_spider, high_water=None):
+    """route_linkedin_rows : Adds the publishers of a batch of LinkedIn rows to every spider whose
+    main_domain matches the row company domain. Rows without a matching spider are dropped.
+
+    Args:
+        rows (list): rows like (company_name_in_linkedin, company_domain, example_job_posting,
+            watermark column).
+        domain_index (dict): index built with build_domain_index.
+        publishers_per_spider (dict): key:value pairs like spider_name:publishers_list, updated
+            in place.
+        high_water (optional): highest watermark seen in the previous batches. Defaults to None.
+
+    Returns:
+        highest watermark seen so far, None if there's none.
+    """
+    for row in rows:
+        if row[3] is not None and (high_water is None or row[3] > high_water):
+            high_water = row[3]
+        matching_spiders = find_spiders_by_domain(row[1], domain_index)
+        if not any(matching_spiders):
+            continue
+        # ? One record is shared by every spider the row matches
+        publisher = Publisher(urllib.parse.unquote(row[0]).replace('-', ' ').title(), row[2])
+        for spider in matching_spiders:
+            publishers_per_spider.setdefault(spider['name'], list()).append(publisher)
+    return high_water
+
+
+def find_spider_by_name(name, spiders, domain_index=None):
+    """find_spider_by_name : Finds the spider whose main_domain matches the name given as an input.
+    When a domain_index is given the name is resolved through it and the list is only scanned if
+    the index has no entry for it.
 
     Args:
         name (str): name of the spider we need to find.
         spiders (list): list of spiders on which the function will iterate.
+        domain_index (dict, optional): index built with build_domain_index. Defaults to None.
 
     Returns:
         dict: the dict object representing the data of the spider found.
     """
+    if domain_index is not None:
+        found = domain_index.get(name.lower())
+        if found:
+            return found[0]
     for spider in spiders:
         if name in spider['main_domain']:
             return spider
 
 
-def generate_start_urls(publishers, spiders):
+@METRICS.timed_stage('start_url_generation')
+def generate_start_urls(publishers, spiders, workers=1):
     """generate_start_urls : Iterates over the input publishers list, then finds the proper spider
     for the current spider_name, if the spider does not exists it continues. If the spider exists
     then iterates over all the publishers for that spider_name, matching the publishers start url 
@@ -146,69 +501,223 @@ def generate_start_urls(publishers, spiders):
     Args:
         publishers (list): list of dicts with key:value like spider_name:publishers_list
         spiders (list): list of spiders
+        workers (int, optional): number of processes to spread the spiders across. Defaults to 1
+            (no process pool).
 
     Returns:
         dict: contains key:value pairs like spider_name:spider_start_urls 
     """
     # Extract domain from publishers URLs
     start_urls = dict()
-    for spider_name, publishers_list in publishers.items():
-        # Find the spider in the spiders list()
-        spider = find_spider_by_name(spider_name.replace('_', '.'), spiders)
-        if spider is None:
-            continue
-
-        spider_start_urls = list()
-        # Iterate over the publishers list for that spider on publishers object
-        for publisher_dict in publishers_list:
-            # Match the raw publisher URL with the spider['start_link_regexp'] field
-            param = None
-            if spider['start_link_regexp'] is not None:
-                retry = True
-                while retry:
-                    if re.match(spider['start_link_regexp'], publisher_dict['start_url']):
-                        param = re.match(
-                            spider['start_link_regexp'], 
-                            publisher_dict['start_url']
-                        ).group(0)
-                        if '/job/' in param:
-                            param = param.split('/job/')[0]
-                        to_add_dict = generate_to_add_dict(publisher_dict, param)
-                        spider_start_urls.append(to_add_dict)
-                        retry = False
-                    # ? If the start_link_regexp is not None but we don't have a match
-                    # ? process URLs further
-                    else:
-                        rearranged_url = rearrange_publisher_url(
-                            publisher_dict['start_url'],
-                            spider_name
-                        )
-                        retry = not publisher_dict['start_url'] == rearranged_url
-                        publisher_dict['start_url'] = rearranged_url
-                continue
-            param = extract_domain_from_url(publisher_dict['start_url'])
-            try:
-                to_add_dict = generate_to_add_dict(
-                    publisher_dict, 
-                    spider['start_link_template'].format(param)
-                )
-                spider_start_urls.append(to_add_dict)
-            except IndexError:
-                to_add_dict = generate_to_add_dict(publisher_dict, publisher_dict['start_url'])
-                spider_start_urls.append(to_add_dict)
+    domain_index = build_domain_index(spiders)
+    tasks = (
+        (spider_name, publishers_list, find_spider_by_name(
+            spider_name.replace('_', '.'), spiders, domain_index
+        ))
+        for spider_name, publishers_list in publishers.items()
+    )
+    if workers > 1:
+        results = generate_start_urls_in_pool(tasks, workers)
+    else:
+        results = (
+            (spider_name, *generate_spider_start_urls(spider_name, publishers_list, spider))
+            for spider_name, publishers_list, spider in tasks if spider is not None
+        )
+    for spider_name, spider_start_urls, spider_stats in results:
         start_urls[spider_name] = spider_start_urls
+        stats = START_LINK_REGEXP_STATS[spider_name]
+        stats['hits'] += spider_stats['hits']
+        stats['rearranged'] += spider_stats['rearranged']
+        stats['misses'] += spider_stats['misses']
+        METRICS.inc('start_link_regexp_hits_total', spider_stats['hits'], spider=spider_name)
+        METRICS.inc('start_link_regexp_misses_total', spider_stats['misses'], spider=spider_name)
+        METRICS.inc('rearrangements_total', spider_stats['rearranged'], spider=spider_name)
+        METRICS.inc('generated_start_urls_total', len(spider_start_urls), spider=spider_name)
+        if stats['rearranged']:
+            logging.info('[!] {}: {} publishers matched, {} rearrangements.'.format(
+                spider_name, stats['hits'], stats['rearranged']
+            ))
     return start_urls
 
 
+def generate_start_urls_in_pool(tasks, workers):
+    """generate_start_urls_in_pool : Runs generate_spider_start_urls for each spider on a process
+    pool. At most two spiders per worker are in flight, and results are yielded in the same order
+    as the tasks so the output does not depend on scheduling.
+
+    Args:
+        tasks (iterable): tuples like (spider_name, publishers_list, spider).
+        workers (int): number of processes.
+
+    Yields:
+        tuple: (spider_name, spider_start_urls, stats) for every spider found.
+    """
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for spider_name, publishers_list, spider in tasks:
+            if spider is None:
+                continue
+            pending.append((spider_name, executor.submit(
+                generate_spider_start_urls, spider_name, list(publishers_list), spider
+            )))
+            if len(pending) >= workers * 2:
+                spider_name, future = pending.popleft()
+                yield (spider_name, *future.result())
+        while pending:
+            spider_name, future = pending.popleft()
+            yield (spider_name, *future.result())
+
+
+def generate_spider_start_urls(spider_name, publishers_list, spider):
+    """generate_spider_start_urls : Generates the start URLs of a single spider.
+
+    Args:
+        spider_name (str): name of the spider file.
+        publishers_list (iterable): publishers of the spider.
+        spider (dict): the spider found for spider_name.
+
+    Returns:
+        tuple: (spider_start_urls, stats) where stats holds the regexp hits, misses and
+            rearrangements.
+    """
+    spider_start_urls = list()
+    pattern = spider.get('start_link_pattern')
+    if pattern is None and spider['start_link_regexp'] is not None:
+        pattern = re.compile(spider['start_link_regexp'])
+    stats = {'hits': 0, 'rearranged': 0, 'misses': 0}
+    # Iterate over the publishers list for that spider on publishers object
+    for publisher in publishers_list:
+        # Match the raw publisher URL with the spider['start_link_regexp'] field
+        param = None
+        start_url = publisher.start_url
+        if pattern is not None:
+            retry = True
+            retries = 0
+            while retry:
+                match = pattern.match(start_url)
+                if match:
+                    param = match.group(0)
+                    if '/job/' in param:
+                        param = param.split('/job/')[0]
+                    spider_start_urls.append(generate_to_add_dict(publisher, param))
+                    stats['hits'] += 1
+                    retry = False
+                # ? If the start_link_regexp is not None but we don't have a match
+                # ? process URLs further
+                else:
+                    rearranged_url = rearrange_publisher_url(start_url, spider_name)
+                    stats['rearranged'] += 1
+                    retries += 1
+                    retry = not start_url == rearranged_url
+                    start_url = rearranged_url
+                    if retry and retries >= MAX_REARRANGE_RETRIES:
+                        logging.info('[!] Giving up rearranging URL: {}'.format(rearranged_url))
+                        retry = False
+                    if not retry:
+                        stats['misses'] += 1
+            continue
+        param = extract_domain_from_url(start_url)
+        try:
+            to_add_dict = generate_to_add_dict(
+                publisher, 
+                spider['start_link_template'].format(param)
+            )
+            spider_start_urls.append(to_add_dict)
+        except IndexError:
+            spider_start_urls.append(generate_to_add_dict(publisher, start_url))
+    return spider_start_urls, stats
+
+
+# ? spider_name:rearranger function, filled by the register_rearranger decorator
+REARRANGERS = dict()
+# ? Rearrangers that need to follow the URL redirects, see preresolve_redirects
+REDIRECT_REARRANGERS = set()
+REARRANGE_CACHE_SIZE = 4096
+# ? Max times a URL is rearranged before giving up on it in generate_spider_start_urls
+MAX_REARRANGE_RETRIES = 5
+_REARRANGER_LOOKUP = dict()
+
+
+def register_rearranger(spider_name, resolves_redirects=False):
+    """register_rearranger : Decorator that registers a function as the URL rearranger of
+    spider_name. Third-party modules can use it to add rearrangers for new spiders.
+
+    Args:
+        spider_name (str): name of the spider file the rearranger applies to.
+        resolves_redirects (bool, optional): the rearranger calls resolve_redirect, so its URLs
+            can be resolved in bulk beforehand. Defaults to False.
+    """
+    def register(function):
+        REARRANGERS[spider_name] = function
+        if resolves_redirects:
+            REDIRECT_REARRANGERS.add(function)
+        _REARRANGER_LOOKUP.clear()
+        rearrange_url.cache_clear()
+        return function
+    return register
+
+
+def get_rearranger(spider_name):
+    """get_rearranger : Finds the rearranger of spider_name, either registered with that exact
+    name or with a name containing it. The result is cached per spider_name.
+
+    Args:
+        spider_name (str): name of the spider file.
+
+    Returns:
+        function: the rearranger, None if there's no rearranger for the spider.
+    """
+    if spider_name not in _REARRANGER_LOOKUP:
+        rearranger = REARRANGERS.get(spider_name)
+        if rearranger is None:
+            rearranger = next(
+                (f for name, f in sorted(REARRANGERS.items()) if spider_name in name), None
+            )
+        _REARRANGER_LOOKUP[spider_name] = rearranger
+    return _REARRANGER_LOOKUP[spider_name]
+
+
+def preresolve_redirects(publishers, spiders, max_workers=8):
+    """preresolve_redirects : Resolves at once, with bounded concurrency, the redirects of every
+    publisher URL that will go through a redirect-following rearranger (the ones not matching
+    their spider's start_link_regexp), so generate_start_urls finds them in the redirect cache.
+
+    Args:
+        publishers (dict): key:value like spider_name:publishers_list
+        spiders (list): list of spiders
+        max_workers (int, optional): max concurrent requests. Defaults to 8.
+    """
+    domain_index = build_domain_index(spiders)
+    urls = list()
+    for spider_name in publishers:
+        if get_rearranger(spider_name) not in REDIRECT_REARRANGERS:
+            continue
+        spider = find_spider_by_name(spider_name.replace('_', '.'), spiders, domain_index)
+        if spider is None or spider.get('start_link_pattern') is None:
+            continue
+        urls += [
+            publisher.start_url for publisher in publishers[spider_name]
+            if not spider['start_link_pattern'].match(publisher.start_url)
+        ]
+    if any(urls):
+        get_redirect_cache().resolve_many(urls, max_workers=max_workers)
+
+
 def rearrange_publisher_url(url, spider_name):
     logging.info('[!] Rearranging URL: {}'.format(url))
+    return rearrange_url(url, spider_name)
+
+
+@lru_cache(maxsize=REARRANGE_CACHE_SIZE)
+def rearrange_url(url, spider_name):
     # Choose the rearranger
-    for f in dir(start_urls_generation):
-        if spider_name in f:
-            return getattr(start_urls_generation, f)(url)
-    return url
+    rearranger = get_rearranger(spider_name)
+    if rearranger is None:
+        return url
+    return rearranger(url)
 
 
+@register_rearranger('brassring')
 def rearrange_brassring(url):
     _format = 'https://{}/TGnewUI/Search/Home/Home?partnerid={}&siteid={}#home'
     domain = extract_domain_from_url(url)
@@ -220,10 +729,13 @@ def rearrange_brassring(url):
     return _format.format(domain, partnerid, siteid)
 
 
+@register_rearranger('ripplehire', resolves_redirects=True)
 def rearrange_ripplehire(url):
     _format = 'https://{}/ripplehire/candidate?token={}#list'
-    r = requests.get(url)
-    domain = extract_domain_from_url(r.url)
+    final_url = resolve_redirect(url)
+    if final_url is None:
+        return url
+    domain = extract_domain_from_url(final_url)
     try:
         token = re.search(r'token\=([a-zA-Z0-9]+)', url).group(1)
     except AttributeError:
@@ -231,6 +743,7 @@ def rearrange_ripplehire(url):
     return _format.format(domain, token)
 
 
+@register_rearranger('myworkday')
 def rearrange_myworkday(url):
     try:
         new_url = re.search(r'(.*)(?=/job)', url).group(0)
@@ -239,49 +752,45 @@ def rearrange_myworkday(url):
     return new_url
 
 
+@register_rearranger('hirehive_com')
 def rearrange_hirehive_com(url):
     _format = 'https://{}.hirehive.com/'
     parsed_url = urlparse(url)
     return _format.format(parsed_url.path.strip('/'))
     
 
-def generate_to_add_dict(publisher_dict, start_url):
-    to_add_dict = {
-        'company_slug': publisher_dict['company_slug'],
-        'company_name': publisher_dict['company_name'],
-        'start_url': start_url
-    } if 'company_slug' in publisher_dict.keys() else {
-        'company_name': publisher_dict['company_name'],
-        'start_url': start_url
-    }
-    return to_add_dict
+def generate_to_add_dict(publisher, start_url):
+    return publisher.with_start_url(start_url)
 
 
-def insert_new_urls_to_repo(start_urls, comparing_publishers, from_action=''):
+@METRICS.timed_stage('repo_diff')
+def insert_new_urls_to_repo(start_urls, comparing_publishers, from_action='', merge=False):
     """insert_new_urls_to_repo : This function compares each new publisher's URL found in the input
-    data against the comparing data.
+    data against the comparing data. When the comparing data is a publishers folder, the
+    comparison runs against its persistent index (see repo_index.ComparingIndexStore).
 
     Args:
         start_urls (dict): input data
         comparing_publishers (dict): comparing data
+        merge (bool, optional): keep the URLs already in the spider's output file that are still
+            not in the comparing data, for incremental runs that only see the new rows.
+            Defaults to False (the file is overwritten).
     """
-    for spider_name, publishers_list in comparing_publishers.items():
+    for spider_name in comparing_publishers:
         spider_new_urls = list()
         if spider_name in start_urls.keys():
+            known_urls = get_comparing_index(spider_name, comparing_publishers).known_urls(
+                in_publisher.start_url for in_publisher in start_urls[spider_name]
+            )
             for in_publisher in start_urls[spider_name]:
-                to_add = True
-                for out_publisher in publishers_list:
-                    if in_publisher['start_url'] == out_publisher['start_url'] or \
-                        in_publisher['start_url'] in out_publisher['start_url']:
-                        to_add = False
-                        break
-                if to_add:
-                    if 'company_slug' in in_publisher.keys():
-                        del(in_publisher['company_slug'])
-                    spider_new_urls.append(in_publisher)
+                if in_publisher.start_url not in known_urls:
+                    spider_new_urls.append((in_publisher.company_name, in_publisher.start_url))
         if len(spider_new_urls) != 0:
+            METRICS.inc('new_urls_total', len(spider_new_urls), spider=spider_name)
+            # ? pandas is only loaded once there is something to save
+            from pandas import DataFrame, concat, read_csv
             # Generates a csv file for the spider if it has new urls
-            df = DataFrame.from_dict(spider_new_urls)
+            df = DataFrame.from_records(spider_new_urls, columns=['company_name', 'start_url'])
             df.drop_duplicates(subset=None, keep='first', inplace=True)
             df.sort_index(inplace=True, ascending=False)
             folder = '/'
@@ -292,6 +801,18 @@ def insert_new_urls_to_repo(start_urls, comparing_publishers, from_action=''):
             else:
                 folder += 'from_google/'
             file_path = 'new_urls{}{}.csv'.format(folder, spider_name)
+            if merge and os.path.exists(file_path) and os.path.getsize(file_path):
+                # ? URLs saved by a previous run and not merged into the repo since then are kept
+                saved = read_csv(
+                    file_path, sep='\t', header=None, names=['company_name', 'start_url'],
+                    dtype=str, keep_default_na=False
+                )
+                known_urls = get_comparing_index(spider_name, comparing_publishers).known_urls(
+                    saved['start_url']
+                )
+                saved = saved[~saved['start_url'].isin(known_urls)]
+                df = concat([saved, df], ignore_index=True)
+                df.drop_duplicates(subset=None, keep='first', inplace=True)
             logging.info('[!] Saving {} to {}'.format(spider_name, folder))
             df.to_csv(
                 file_path, 
@@ -302,24 +823,38 @@ def insert_new_urls_to_repo(start_urls, comparing_publishers, from_action=''):
             )
                 
 
+@METRICS.timed_stage('query_generation')
 def generate_google_query(
         db_host, db_user, db_pass, db_name,
-        google_include_tpl, google_ignore1_tpl, look_for=None, query=''):
+        google_include_tpl, google_ignore1_tpl, look_for=None, query='', spiders=None):
     # you can generate queries only for some spiders by adding them as cmd params
+    # ? If spiders (as loaded by load_spiders) are given, no query is made to the database
 
-    addit = ''
-    if isinstance(look_for, list):
-        addit = " AND `name` IN ('{}')".format("', '".join(look_for))
     if isinstance(look_for, str):
-        addit = " AND `name` IN ('{}')".format(look_for)
-
-    # Connection to db
-    db = MySQLdb.connect(db_host, db_user, db_pass, db_name, use_unicode=True, charset='utf8')
-    cursor = db.cursor()
-    sql = query.format(addit)
-
-    cursor.execute(sql)
-    lst = cursor.fetchall()
+        look_for = [look_for]
+    if spiders is not None:
+        # ? Queries don't depend on start_link_regexp, spiders rejected for it are searched too
+        lst = [
+            (
+                spider['id'], spider['name'], spider['main_domain'],
+                spider['ignored_subdomains'], spider['google_query']
+            )
+            for spider in list(spiders) + getattr(spiders, 'rejected', list())
+            if look_for is None or spider['name'] in look_for
+        ]
+    else:
+        addit = ''
+        if isinstance(look_for, list):
+            addit = " AND `name` IN ('{}')".format("', '".join(look_for))
+
+        # Connection to db
+        with get_mysql_connection_pool(db_host, db_user, db_pass, db_name).connection() as db:
+            cursor = db.cursor()
+            sql = query.format(addit)
+
+            cursor.execute(sql)
+            lst = cursor.fetchall()
+            cursor.close()
     queries = dict()
     spiders_names = list()
     for row in lst:
@@ -342,85 +877,34 @@ def generate_google_query(
     return queries
     
 
-def make_google_query(queries_dict, max_urls, deepnest=0):
-    driver = get_chromedriver(
-        # headless=True,
-        user_agent=get_user_agent(),
-        fast_load=True,
-        images=True
-    )
-    js = ''
+@METRICS.timed_stage('serp_fetch')
+def make_google_query(queries_dict, max_urls, deepnest=0, browsers=1, proxies=None,
+                      queries_per_minute=None, journal=None, backend='browser'):
+    """make_google_query : Performs the Google queries of every spider on a pool of browsers
+    paced by per-egress token buckets (see serp_scheduler.SerpScheduler).
 
-    # Load the JavaScript to generate URLs from serach results
-    with open('Internet Marketing Ninjas SERP Extractor User.js') as script:
-        js = script.read()
-    
-    spiders_results = dict()
-
-    for spider_name, queries in queries_dict.items():
-        urls = list()
-        for query in queries:
-            query = query.strip().replace(' ', '%20')
-            try:
-                get_webpage(
-                    driver=driver, 
-                    url='https://www.google.com/search?q={}&start={}'.format(query, deepnest),
-                    wait_for_element='//div[contains(@class, "rc")]'
-                )
-            except Exception:
-                get_webpage(
-                    driver=driver, 
-                    url='https://www.google.com/search?q={}'.format(query),
-                    wait_for_element='//div[contains(@class, "rc")]'
-                )
+    Args:
+        queries_dict (dict): key:value pairs like spider_name:queries_list
+        max_urls (int): max number of URLs to collect per spider.
+        deepnest (int, optional): page to start looking for. Defaults to 0.
+        browsers (int, optional): number of browsers. Defaults to 1.
+        proxies (list, optional): proxies for the browsers. Defaults to None.
+        queries_per_minute (float, optional): pace of each egress. Defaults to
+            serp_scheduler.QUERIES_PER_MINUTE.
+        journal (CheckpointJournal, optional): journal of the queries already performed.
+            Defaults to None.
+        backend (str, optional): 'browser' (Chrome + SERP extractor user script) or 'html'
+            (raw pages parsed with lxml, no browser). Defaults to 'browser'.
 
-            while True:
-                try:
-                    driver.execute_script(js)
-                except JavascriptException:
-                    logging.info('[!] Error executing Javascript. Retrying...')
-                    if 'sorry' in driver.current_url:
-                        logging.info('[!] Blocked...')
-                        break
-                    time.sleep(random.uniform(0.6, 1.8) * 5)
-                    continue
-                time.sleep(random.uniform(0.6, 1.8) * 10)
-                urls += [anchor.get_attribute('href') for anchor in driver.find_elements_by_xpath(
-                    '//h2[contains(text(), "Organic Results")]/following-sibling::ol//li//a'
-                )]
-
-                # ? Check if google hide links due to repetition
-                if show_repeated_results(driver, urls, max_urls):
-                    continue
-                # ? Check if there's a "Next" button
-                if go_to_next_page(driver, urls, max_urls):
-                    continue
-                break
-        if any(urls):
-            spiders_results[spider_name] = urls
-        if len(queries_dict.keys()) > 1:
-            logging.info('[!] Waiting 2 minutes to extract the following spider.')
-            time.sleep(120)
-    driver.close()
-    del(driver)
-    return(spiders_results)
-
-
-def go_to_next_page(driver, urls, max_urls):
-    next_button = driver.find_elements_by_xpath('//a[@id="pnnext"]')
-    if any(next_button) and len(urls) < max_urls:
-        next_button[0].click()
-        time.sleep(random.uniform(0.6, 1.8) * 10)
-        return True
-    return False
-
-
-def show_repeated_results(driver, urls, max_urls):
-    repeat_with_all_results = driver.find_elements_by_xpath(
-        '//*[@id="ofr"]/i/a'
+    Returns:
+        dict: key:value pairs like spider_name:urls
+    """
+    # ? Only the actions searching Google import serp_scheduler
+    from serp_scheduler import QUERIES_PER_MINUTE, SerpScheduler
+    scheduler = SerpScheduler(
+        browsers=browsers,
+        proxies=proxies,
+        queries_per_minute=queries_per_minute or QUERIES_PER_MINUTE,
+        backend=backend
     )
-    if any(repeat_with_all_results) and len(urls) < max_urls:
-        repeat_with_all_results[0].click()
-        time.sleep(random.uniform(0.6, 1.8) * 10)
-        return True
-    return False
+    return scheduler.run(queries_dict, max_urls, deepnest=deepnest, journal=journal)
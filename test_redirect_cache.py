@@ -0,0 +1,158 @@
+import threading
+from http.server import BaseHTTPRequestHandler
+
+import pytest
+
+import start_urls_generation
+from load_test import start_server
+from redirect_cache import RedirectCache, get_redirect_cache
+from sqlite_store import close_process_store, set_process_store
+
+
+class FakeRedirectHandler(BaseHTTPRequestHandler):
+    """FakeRedirectHandler : Stand-in for the redirecting job boards. /r/<name> redirects to
+    /final/<name>, /final/<name> answers 200 and /broken drops the connection without answering.
+    Every request is counted per path (without the query string) on the server.
+    """
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        with self.server.lock:
+            self.server.hits[path] = self.server.hits.get(path, 0) + 1
+        if path.startswith('/r/'):
+            self.send_response(302)
+            self.send_header('Location', path.replace('/r/', '/final/', 1))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif path.startswith('/final/'):
+            body = b'<html><body>final</body></html>'
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            # ? No status line at all, requests raises a ConnectionError
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class RedirectServer():
+    """RedirectServer : Running FakeRedirectHandler server with helpers to build its URLs and read
+    its request counts."""
+
+    def __init__(self):
+        self.server = start_server(FakeRedirectHandler, hits=dict(), lock=threading.Lock())
+        self.base_url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def url(self, path):
+        return self.base_url + path
+
+    def hits(self, path):
+        with self.server.lock:
+            return self.server.hits.get(path, 0)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def server():
+    server = RedirectServer()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = RedirectCache(str(tmp_path / 'redirect_cache.sqlite'))
+    yield cache
+    cache.db.close()
+
+
+def backdate(cache, url, seconds):
+    cache.write(
+        'UPDATE redirects SET resolved_at = resolved_at - ? WHERE url = ?', (seconds, url)
+    )
+
+
+def test_resolve_is_cached(server, cache):
+    url = server.url('/r/one')
+    assert cache.resolve(url) == server.url('/final/one')
+    assert cache.resolve(url) == server.url('/final/one')
+    assert server.hits('/r/one') == 1
+    assert cache.get(url) == (True, server.url('/final/one'))
+
+
+def test_resolve_after_ttl(server, cache):
+    url = server.url('/r/one')
+    cache.resolve(url)
+    backdate(cache, url, cache.ttl - 60)
+    assert cache.get(url)[0]
+    backdate(cache, url, 120)
+    assert cache.get(url) == (False, None)
+    assert cache.resolve(url) == server.url('/final/one')
+    assert server.hits('/r/one') == 2
+
+
+def test_failures_are_cached_for_negative_ttl(server, cache):
+    url = server.url('/broken')
+    assert cache.resolve(url) is None
+    assert cache.get(url) == (True, None)
+    assert cache.resolve(url) is None
+    assert server.hits('/broken') == 1
+    # ? A failure older than the negative TTL is retried even though it is within the TTL
+    backdate(cache, url, cache.negative_ttl + 60)
+    assert cache.get(url) == (False, None)
+    cache.resolve(url)
+    assert server.hits('/broken') == 2
+
+
+def test_resolve_many(server, cache):
+    names = ['many_{}'.format(i) for i in range(20)]
+    cache.resolve(server.url('/r/one'))
+    cache.resolve(server.url('/broken'))
+    urls = [server.url('/r/' + name) for name in names]
+    urls += urls[:5] + [server.url('/r/one'), server.url('/broken')]
+
+    expected = {server.url('/r/' + name): server.url('/final/' + name) for name in names}
+    expected.update({server.url('/r/one'): server.url('/final/one'), server.url('/broken'): None})
+    assert cache.resolve_many(urls, max_workers=4) == expected
+    assert [server.hits('/r/' + name) for name in names] == [1] * 20
+    assert (server.hits('/r/one'), server.hits('/broken')) == (1, 1)
+
+
+def test_preresolve_redirects_feeds_ripplehire(server, cache):
+    spiders = start_urls_generation.compile_spiders_regexps([{
+        'id': 1, 'name': 'ripplehire', 'main_domain': 'ripplehire.com',
+        'start_link_regexp': r'^https://[^/]+/ripplehire/candidate\?token=',
+    }])
+    tokens = ['token{}'.format(i) for i in range(10)]
+    publishers = {'ripplehire': [
+        start_urls_generation.Publisher(
+            'Company {}'.format(token), server.url('/r/{}?token={}'.format(token, token))
+        )
+        for token in tokens
+    ]}
+    set_process_store(cache)
+    try:
+        start_urls_generation.preresolve_redirects(publishers, spiders, max_workers=4)
+        assert get_redirect_cache() is cache
+        assert [server.hits('/r/' + token) for token in tokens] == [1] * 10
+
+        domain = start_urls_generation.extract_domain_from_url(server.base_url)
+        rearranged = [
+            start_urls_generation.rearrange_url(publisher.start_url, 'ripplehire')
+            for publisher in publishers['ripplehire']
+        ]
+        assert rearranged == [
+            'https://{}/ripplehire/candidate?token={}#list'.format(domain, token)
+            for token in tokens
+        ]
+        # ? The rearranger found every URL in the cache
+        assert [server.hits('/r/' + token) for token in tokens] == [1] * 10
+    finally:
+        close_process_store(RedirectCache)